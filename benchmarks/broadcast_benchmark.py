@@ -0,0 +1,180 @@
+"""
+Бенчмарк пропускной способности рассылки на заглушке Bot API
+
+Для каждого размера аудитории в отдельном процессе создается временная БД
+с синтетическими пользователями и выполняется задача рассылки через
+run_broadcast_job. Отдельный процесс нужен, чтобы пиковый RSS относился
+к одному прогону. Заглушка Bot API работает в родительском процессе.
+
+Запуск (из корня проекта):
+    python -m benchmarks.broadcast_benchmark --users 1000 10000 100000
+    python -m benchmarks.broadcast_benchmark --users 10000 --rate-limit 30 --rate 25
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# config требует токен, для бенчмарка подойдет любой
+os.environ.setdefault('TOKEN', '123456:BENCHMARK')
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from database.models import Base, User
+from database.orm_query import create_broadcast_job, get_broadcast_latency_percentiles
+from utils import broadcast_utils
+from utils.broadcast_jobs import run_broadcast_job
+from benchmarks.mock_bot_api import MockBotAPI, start_mock_server
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+INSERT_BATCH = 10000
+
+
+def peak_rss_mb() -> float | None:
+    """Пиковый RSS текущего процесса в МБ (ru_maxrss в Linux в КБ, в macOS в байтах)"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def configure_engine(rate: float, workers: int):
+    """Переопределяет лимиты рассылки для прогона (0 - без ограничения скорости)"""
+    broadcast_utils.broadcast_governor.max_rate = rate
+    broadcast_utils.broadcast_limiter.set_rate(rate)
+    broadcast_utils.BROADCAST_WORKERS = workers
+
+
+async def seed_users(session_pool: async_sessionmaker, users: int):
+    async with session_pool() as session:
+        for start in range(1, users + 1, INSERT_BATCH):
+            stop = min(start + INSERT_BATCH, users + 1)
+            await session.execute(insert(User), [{'tg_id': tg_id, 'name': f'user{tg_id}'} for tg_id in range(start, stop)])
+        await session.commit()
+
+
+async def run_single(users: int, api_url: str, rate: float, workers: int, db_url: str | None = None) -> dict:
+    """Один прогон рассылки на users пользователей, возвращает метрики"""
+    configure_engine(rate, workers)
+    tmp_dir = None
+    if db_url is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        db_url = f"sqlite+aiosqlite:///{Path(tmp_dir.name) / 'benchmark.db'}"
+    engine = create_async_engine(db_url, echo=False)
+    session_pool = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    bot = Bot(token=os.environ['TOKEN'], session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)))
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+        await seed_users(session_pool, users)
+
+        async with session_pool() as session:
+            job = await create_broadcast_job(session, 'send_message', 'бенчмарк', {'text': 'Benchmark'})
+            started = time.perf_counter()
+            stats = await run_broadcast_job(bot, session, job)
+            elapsed = time.perf_counter() - started
+            latency = await get_broadcast_latency_percentiles(session, job.id, (50, 99))
+    finally:
+        await bot.session.close()
+        await engine.dispose()
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    return {
+        'users': users,
+        'sent': stats.success,
+        'failed': stats.failed,
+        'deactivated': stats.deactivated,
+        'flood_waits': stats.flood_waits,
+        'elapsed': round(elapsed, 2),
+        'msgs_per_sec': round(stats.processed / elapsed, 1) if elapsed else 0,
+        'p50_ms': latency.get(50),
+        'p99_ms': latency.get(99),
+        'peak_rss_mb': round(peak_rss_mb(), 1) if resource is not None else None,
+    }
+
+
+async def run_child_process(users: int, args: argparse.Namespace, api_url: str) -> dict:
+    command = [
+        sys.executable, '-m', 'benchmarks.broadcast_benchmark',
+        '--child', str(users), '--api-url', api_url,
+        '--rate', str(args.rate), '--workers', str(args.workers),
+    ]
+    if args.db_url:
+        command += ['--db-url', args.db_url]
+    process = await asyncio.create_subprocess_exec(*command, cwd=BASE_DIR, stdout=asyncio.subprocess.PIPE)
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"Прогон на {users} пользователей завершился с кодом {process.returncode}")
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+
+def print_table(results: list[dict]):
+    header = f"{'users':>8} {'sent':>8} {'failed':>7} {'429':>5} {'time, s':>8} {'msg/s':>8} {'p50, ms':>8} {'p99, ms':>8} {'RSS, MB':>8}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(
+            f"{r['users']:>8} {r['sent']:>8} {r['failed']:>7} {r['flood_waits']:>5} {r['elapsed']:>8} "
+            f"{r['msgs_per_sec']:>8} {str(r['p50_ms']):>8} {str(r['p99_ms']):>8} {str(r['peak_rss_mb']):>8}"
+        )
+
+
+async def run_benchmark(args: argparse.Namespace):
+    api = MockBotAPI(args.latency, args.jitter, args.rate_limit, args.retry_after, args.blocked)
+    runner = await start_mock_server(api, port=args.port)
+    api_url = f"http://127.0.0.1:{args.port}"
+    results = []
+    try:
+        for users in args.users:
+            print(f"Рассылка на {users} пользователей...", flush=True)
+            results.append(await run_child_process(users, args, api_url))
+    finally:
+        await runner.cleanup()
+    print()
+    print_table(results)
+    print(f"\nЗаглушка: запросов {api.stats['requests']}, 429 {api.stats['flood']}, "
+          f"403 {api.stats['blocked']}, максимум параллельных {api.stats['max_in_flight']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк рассылки на заглушке Bot API')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000], help='Размеры аудитории')
+    parser.add_argument('--rate', type=float, default=0, help='Лимит скорости рассылки, сообщ./с (0 - без лимита)')
+    parser.add_argument('--workers', type=int, default=broadcast_utils.BROADCAST_WORKERS, help='Количество воркеров')
+    parser.add_argument('--db-url', help='БД для прогона (по умолчанию временная SQLite), таблицы пересоздаются')
+    parser.add_argument('--port', type=int, default=8081, help='Порт заглушки Bot API')
+    parser.add_argument('--latency', type=float, default=0.03, help='Средняя задержка заглушки (сек)')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Разброс задержки заглушки (сек)')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Лимит заглушки до ответа 429, сообщ./с (0 - без лимита)')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответе 429 (сек)')
+    parser.add_argument('--blocked', type=float, default=0.01, help='Доля пользователей, заблокировавших бота')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--api-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        # Предупреждения о каждом заблокировавшем бота пользователе только мешают замерам
+        logging.basicConfig(level=logging.ERROR)
+        result = asyncio.run(run_single(args.child, args.api_url, args.rate, args.workers, args.db_url))
+        print(json.dumps(result))
+    else:
+        asyncio.run(run_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
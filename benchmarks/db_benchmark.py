@@ -0,0 +1,164 @@
+"""
+Бенчмарк БД под конкурентной нагрузкой обработчиков
+
+Имитирует одновременные нажатия кнопок: каждое обновление открывает свою
+сессию, как middleware DataBaseSession, и выполняет типичный для бота набор
+запросов (get_or_create_user, чтение прогресса, старт и продвижение по воронке).
+Профили движка сравниваются на отдельных временных БД с одинаковой нагрузкой.
+
+Запуск (из корня проекта):
+    python -m benchmarks.db_benchmark --updates 5000 --concurrency 100
+    python -m benchmarks.db_benchmark --profiles tuned --db-url sqlite+aiosqlite:///bench.db
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+# config требует токен, для бенчмарка подойдет любой
+os.environ.setdefault('TOKEN', '123456:BENCHMARK')
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from database.engine import build_engine
+from database.models import Base, User, Funnel, FunnelStep
+from database.orm_query import (
+    get_or_create_user,
+    get_active_funnels,
+    get_user_all_funnel_progress,
+    get_user_funnel_progress,
+    start_user_funnel,
+    advance_user_funnel,
+    reset_user_funnel_progress,
+)
+
+FUNNEL_STEPS = 5
+
+
+async def seed(session_pool: async_sessionmaker, users: int) -> int:
+    """Создает пользователей и воронку из бесплатных этапов, возвращает id воронки"""
+    async with session_pool() as session:
+        await session.execute(insert(User), [{'tg_id': tg_id, 'name': f'user{tg_id}'} for tg_id in range(1, users + 1)])
+        funnel = Funnel(name='Бенчмарк', description='Воронка для бенчмарка')
+        session.add(funnel)
+        await session.flush()
+        session.add_all([
+            FunnelStep(funnel_id=funnel.id, order=order, title=f'Этап {order}', content='Текст', content_type='text')
+            for order in range(1, FUNNEL_STEPS + 1)
+        ])
+        await session.commit()
+        return funnel.id
+
+
+async def handle_update(session_pool: async_sessionmaker, tg_id: int, funnel_id: int, action: float) -> bool:
+    """Одно обновление от пользователя, возвращает False при ошибке БД"""
+    async with session_pool() as session:
+        await get_or_create_user(session, tg_id, f'user{tg_id}')
+        if action < 0.4:
+            await get_user_all_funnel_progress(session, tg_id)
+        elif action < 0.6:
+            await get_active_funnels(session)
+        else:
+            progress = await get_user_funnel_progress(session, tg_id, funnel_id)
+            if progress is None:
+                return await start_user_funnel(session, tg_id, funnel_id) is not None
+            if progress.is_completed:
+                await reset_user_funnel_progress(session, tg_id, funnel_id)
+            else:
+                await advance_user_funnel(session, tg_id, funnel_id)
+    return True
+
+
+async def run_profile(profile: str, args: argparse.Namespace) -> dict:
+    tmp_dir = None
+    db_url = args.db_url
+    if db_url is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        db_url = f"sqlite+aiosqlite:///{Path(tmp_dir.name) / 'benchmark.db'}"
+    engine = build_engine(db_url, profile)
+    session_pool = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+        funnel_id = await seed(session_pool, args.users)
+        journal_mode = None
+        if engine.dialect.name == 'sqlite':
+            async with engine.connect() as conn:
+                journal_mode = await conn.scalar(text('PRAGMA journal_mode'))
+
+        rng = random.Random(args.seed)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies: list[float] = []
+        errors = 0
+
+        async def one(tg_id: int, action: float):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    if not await handle_update(session_pool, tg_id, funnel_id, action):
+                        errors += 1
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        updates = [(rng.randint(1, args.users), rng.random()) for _ in range(args.updates)]
+        started = time.perf_counter()
+        await asyncio.gather(*(one(tg_id, action) for tg_id, action in updates))
+        elapsed = time.perf_counter() - started
+    finally:
+        await engine.dispose()
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    latencies.sort()
+    return {
+        'profile': profile,
+        'journal_mode': journal_mode,
+        'elapsed': elapsed,
+        'rps': args.updates / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000,
+        'errors': errors,
+    }
+
+
+async def run_benchmark(args: argparse.Namespace):
+    results = []
+    for profile in args.profiles:
+        print(f"Профиль {profile}: {args.updates} обновлений, параллельно {args.concurrency}...", flush=True)
+        results.append(await run_profile(profile, args))
+
+    print()
+    header = f"{'profile':>8} {'journal':>8} {'time, s':>8} {'upd/s':>8} {'p50, ms':>8} {'p99, ms':>8} {'errors':>7}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(
+            f"{r['profile']:>8} {str(r['journal_mode']):>8} {r['elapsed']:>8.2f} {r['rps']:>8.1f} "
+            f"{r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['errors']:>7}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк профилей движка БД под конкурентной нагрузкой')
+    parser.add_argument('--profiles', nargs='+', default=['default', 'tuned'], help='Профили движка для сравнения')
+    parser.add_argument('--updates', type=int, default=5000, help='Количество обновлений')
+    parser.add_argument('--concurrency', type=int, default=100, help='Одновременно обрабатываемых обновлений')
+    parser.add_argument('--users', type=int, default=1000, help='Количество пользователей в БД')
+    parser.add_argument('--seed', type=int, default=1, help='Seed генератора нагрузки')
+    parser.add_argument('--db-url', help='БД для прогона (по умолчанию временная SQLite), таблицы пересоздаются')
+    args = parser.parse_args()
+    # Ошибки считаются в итоговой таблице, трейсбеки только мешают замерам
+    logging.basicConfig(level=logging.CRITICAL)
+    asyncio.run(run_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочных тестов рассылок
+
+Запуск:
+    python -m benchmarks.mock_bot_api --port 8081 --latency 0.03 --rate-limit 30 --blocked 0.01
+
+Бот подключается к ней через переменную окружения TELEGRAM_API_URL=http://127.0.0.1:8081
+
+Обновления для поллинга добавляются через push_update, getUpdates отдает их
+с учетом offset и ждет новые до timeout, как настоящий long polling.
+"""
+import argparse
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from typing import Callable
+from aiohttp import web
+
+
+class MockBotAPI:
+    """
+    Имитация Bot API: задержка ответа, флуд-контроль (429) и заблокировавшие бота пользователи (403)
+
+    Args:
+        latency: Средняя задержка ответа (сек)
+        jitter: Разброс задержки (сек)
+        rate_limit: Сколько отправок в секунду принимается до ответа 429 (0 - без ограничений)
+        retry_after: Значение retry_after в ответе 429 (сек)
+        blocked_ratio: Доля пользователей, заблокировавших бота
+    """
+    # Методы, которые отправляют сообщение пользователю и попадают под лимиты
+    SEND_METHODS = {'sendmessage', 'sendvideo', 'sendvideonote', 'sendphoto', 'senddocument', 'sendsticker'}
+
+    def __init__(
+        self,
+        latency: float = 0.03,
+        jitter: float = 0.02,
+        rate_limit: float = 0,
+        retry_after: int = 1,
+        blocked_ratio: float = 0.01,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.blocked_ratio = blocked_ratio
+        self._window: deque[float] = deque()
+        self._flood_until = 0.0
+        self._message_id = 0
+        self._updates: deque[dict] = deque()
+        self._new_updates = asyncio.Event()
+        # Вызывается при каждой успешной отправке: on_send(chat_id, data)
+        self.on_send: Callable[[int, dict], None] | None = None
+        self.stats = {'requests': 0, 'sent': 0, 'flood': 0, 'blocked': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+    def is_blocked(self, chat_id: int) -> bool:
+        """Детерминированно выбирает заблокировавших бота пользователей по chat_id"""
+        return (chat_id * 2654435761) % 10000 < self.blocked_ratio * 10000
+
+    def check_flood(self) -> int | None:
+        """Возвращает retry_after, если лимит отправок превышен"""
+        if self.rate_limit <= 0:
+            return None
+        now = time.monotonic()
+        if now < self._flood_until:
+            return math.ceil(self._flood_until - now)
+        while self._window and self._window[0] <= now - 1:
+            self._window.popleft()
+        if len(self._window) >= self.rate_limit:
+            # Как и Telegram, после превышения лимита отклоняем все отправки до конца паузы
+            self._flood_until = now + self.retry_after
+            return self.retry_after
+        self._window.append(now)
+        return None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        data = dict(await request.post()) if request.method == 'POST' else dict(request.query)
+        self.stats['requests'] += 1
+        self.stats['in_flight'] += 1
+        self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+        try:
+            if self.latency or self.jitter:
+                await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+            if method == 'getupdates':
+                result = {'ok': True, 'result': await self.get_updates(data)}
+            else:
+                result = self.dispatch(method, data)
+            # aiogram выбирает класс исключения по HTTP-статусу ответа
+            return web.json_response(result, status=result.get('error_code', 200))
+        finally:
+            self.stats['in_flight'] -= 1
+
+    def push_update(self, update: dict):
+        """Добавляет обновление в очередь getUpdates"""
+        self._updates.append(update)
+        self._new_updates.set()
+
+    async def get_updates(self, data: dict) -> list[dict]:
+        offset = int(data.get('offset') or 0)
+        limit = int(data.get('limit') or 100)
+        timeout = float(data.get('timeout') or 0)
+        # Как и Telegram, offset подтверждает все обновления с меньшим update_id
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [update for _, update in zip(range(limit), self._updates)]
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def dispatch(self, method: str, data: dict) -> dict:
+        if method in self.SEND_METHODS:
+            chat_id = int(data.get('chat_id', 0))
+            retry_after = self.check_flood()
+            if retry_after is not None:
+                self.stats['flood'] += 1
+                return {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {retry_after}',
+                    'parameters': {'retry_after': retry_after},
+                }
+            if self.is_blocked(chat_id):
+                self.stats['blocked'] += 1
+                return {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+            self.stats['sent'] += 1
+            if self.on_send is not None:
+                self.on_send(chat_id, data)
+            return {'ok': True, 'result': self.make_message(chat_id, data)}
+        if method == 'getme':
+            return {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Mock', 'username': 'mock_bot'}}
+        if method == 'editmessagetext':
+            return {'ok': True, 'result': self.make_message(int(data.get('chat_id', 0)), data)}
+        # deleteWebhook, setWebhook, answerCallbackQuery, deleteMessage и прочие
+        return {'ok': True, 'result': True}
+
+    def make_message(self, chat_id: int, data: dict) -> dict:
+        self._message_id += 1
+        message = {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        if 'text' in data:
+            message['text'] = data['text']
+        return message
+
+
+async def start_mock_server(api: MockBotAPI, host: str = '127.0.0.1', port: int = 8081) -> web.AppRunner:
+    """Запускает заглушку в текущем event loop. Остановка: await runner.cleanup()"""
+    runner = web.AppRunner(api.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заглушка Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.03, help='Средняя задержка ответа (сек)')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Разброс задержки (сек)')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Отправок в секунду до ответа 429 (0 - без лимита)')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after в ответе 429 (сек)')
+    parser.add_argument('--blocked', type=float, default=0.01, help='Доля пользователей, заблокировавших бота')
+    args = parser.parse_args()
+
+    api = MockBotAPI(args.latency, args.jitter, args.rate_limit, args.retry_after, args.blocked)
+    web.run_app(api.make_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Бенчмарк задержки обработки обновлений: long polling против вебхука
+
+Генератор отправляет обновления "/help" с заданной частотой, каждое от
+нового пользователя. В режиме polling они попадают в очередь getUpdates
+заглушки Bot API, в режиме webhook отправляются POST-запросом на сервер
+вебхука бота (не больше --connections одновременно, как делает Telegram).
+Задержка - время от появления обновления до ответа бота sendMessage
+в заглушке. Заглушка добавляет --latency к каждому запросу к Bot API,
+включая getUpdates. Обработчики, middleware и лимит одновременной обработки
+(UPDATES_MAX_IN_FLIGHT) те же, что в run.py.
+
+Колонка "соедин." - сколько раз за прогон бралось соединение из пула БД.
+/help не работает с БД, поэтому там должен быть 0: ленивая сессия
+DataBaseSession (и обновление last_seen в ней) не трогает пул без запросов.
+
+Запуск (из корня проекта):
+    python -m benchmarks.update_latency --updates 2000 --rate 500
+    python -m benchmarks.update_latency --modes webhook --rate 0 --max-in-flight 20
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+# config требует токен, для бенчмарка подойдет любой
+os.environ.setdefault('TOKEN', '123456:BENCHMARK')
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from config import UPDATES_MAX_IN_FLIGHT
+from database.engine import build_engine
+from database.models import Base
+from handlers.user_router import user_router
+from middleware.concurrency import UpdatesConcurrencyLimit
+from middleware.db import DataBaseSession
+from utils.webhook import start_webhook_server
+from benchmarks.mock_bot_api import MockBotAPI, start_mock_server
+
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = 'benchmark-secret'
+
+
+def make_update(update_id: int) -> dict:
+    """Команда /help от пользователя с chat_id = update_id"""
+    user = {'id': update_id, 'is_bot': False, 'first_name': f'user{update_id}'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': update_id, 'type': 'private'},
+            'from': user,
+            'text': '/help',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+        },
+    }
+
+
+async def generate(updates: range, rate: float, deliver) -> dict[int, float]:
+    """Отправляет обновления с частотой rate в секунду (0 - все сразу), возвращает время появления каждого"""
+    sent_at: dict[int, float] = {}
+    tasks = []
+    started = time.perf_counter()
+    for number, update_id in enumerate(updates):
+        if rate > 0:
+            delay = started + number / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sent_at[update_id] = time.perf_counter()
+        tasks.append(asyncio.create_task(deliver(make_update(update_id))))
+    await asyncio.gather(*tasks)
+    return sent_at
+
+
+async def wait_answers(answered_at: dict[int, float], expected: int, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while len(answered_at) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+
+
+async def run_polling(dp: Dispatcher, bot: Bot, api: MockBotAPI, updates: range, answered_at: dict[int, float], args: argparse.Namespace) -> dict[int, float]:
+    async def deliver(update: dict):
+        api.push_update(update)
+
+    polling = asyncio.create_task(dp.start_polling(
+        bot, handle_signals=False, close_bot_session=False
+    ))
+    try:
+        return await generate(updates, args.rate, deliver)
+    finally:
+        await wait_answers(answered_at, len(updates), args.timeout)
+        await dp.stop_polling()
+        await polling
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, api: MockBotAPI, updates: range, answered_at: dict[int, float], args: argparse.Namespace) -> dict[int, float]:
+    url = f'http://127.0.0.1:{args.webhook_port}{WEBHOOK_PATH}'
+    headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+    runner = await start_webhook_server(
+        dp, bot, WEBHOOK_PATH, '127.0.0.1', args.webhook_port, secret_token=WEBHOOK_SECRET
+    )
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.connections)) as http:
+            async def deliver(update: dict):
+                async with http.post(url, json=update, headers=headers) as response:
+                    response.raise_for_status()
+
+            sent_at = await generate(updates, args.rate, deliver)
+            await wait_answers(answered_at, len(updates), args.timeout)
+            return sent_at
+    finally:
+        await runner.cleanup()
+
+
+def summarize(mode: str, sent_at: dict[int, float], answered_at: dict[int, float], checkouts: int) -> dict:
+    latencies = sorted((answered_at[update_id] - sent) * 1000 for update_id, sent in sent_at.items() if update_id in answered_at)
+    result = {'mode': mode, 'updates': len(sent_at), 'answered': len(latencies), 'checkouts': checkouts}
+    if latencies:
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [latencies[0]] * 99
+        span = max(answered_at[update_id] for update_id in sent_at if update_id in answered_at) - min(sent_at.values())
+        result.update(
+            p50=quantiles[49], p95=quantiles[94], p99=quantiles[98], max=latencies[-1],
+            throughput=len(latencies) / span if span > 0 else 0.0,
+        )
+    return result
+
+
+async def run_benchmark(args: argparse.Namespace) -> list[dict]:
+    api = MockBotAPI(latency=args.latency, jitter=args.jitter, blocked_ratio=0)
+    answered_at: dict[int, float] = {}
+    api.on_send = lambda chat_id, data: answered_at.setdefault(chat_id, time.perf_counter())
+    mock_runner = await start_mock_server(api, port=args.api_port)
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    engine = build_engine(f"sqlite+aiosqlite:///{Path(tmp_dir.name) / 'benchmark.db'}")
+    session_pool = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    pool_checkouts = [0]
+    event.listen(engine.sync_engine, 'checkout', lambda *_: pool_checkouts.__setitem__(0, pool_checkouts[0] + 1))
+
+    dp = Dispatcher()
+    dp.update.outer_middleware(UpdatesConcurrencyLimit(args.max_in_flight))
+    dp.update.middleware(DataBaseSession(session_pool=session_pool))
+    dp.include_router(user_router)
+    runners = {'polling': run_polling, 'webhook': run_webhook}
+    results = []
+    try:
+        for number, mode in enumerate(args.modes):
+            # Свои update_id у каждого режима, чтобы ответы не смешивались
+            updates = range(number * args.updates + 1, (number + 1) * args.updates + 1)
+            # Сессию бота закрывает сервер вебхука, поэтому у каждого режима свой бот
+            checkouts_before = pool_checkouts[0]
+            bot = Bot(token=os.environ['TOKEN'], session=AiohttpSession(api=TelegramAPIServer.from_base(f'http://127.0.0.1:{args.api_port}')))
+            try:
+                sent_at = await runners[mode](dp, bot, api, updates, answered_at, args)
+            finally:
+                await bot.session.close()
+            results.append(summarize(mode, sent_at, answered_at, pool_checkouts[0] - checkouts_before))
+    finally:
+        await engine.dispose()
+        await mock_runner.cleanup()
+        tmp_dir.cleanup()
+    return results
+
+
+def print_results(results: list[dict]):
+    print(f"{'режим':>8} {'обновл.':>8} {'ответов':>8} {'p50, мс':>8} {'p95, мс':>8} {'p99, мс':>8} {'max, мс':>8} {'upd/s':>8} {'соедин.':>8}")
+    for result in results:
+        if result['answered']:
+            print(
+                f"{result['mode']:>8} {result['updates']:>8} {result['answered']:>8} {result['p50']:>8.1f} "
+                f"{result['p95']:>8.1f} {result['p99']:>8.1f} {result['max']:>8.1f} {result['throughput']:>8.1f} {result['checkouts']:>8}"
+            )
+        else:
+            print(f"{result['mode']:>8} {result['updates']:>8} {0:>8} {'':>44} {result['checkouts']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Задержка обработки обновлений: polling против webhook')
+    parser.add_argument('--modes', nargs='+', choices=['polling', 'webhook'], default=['polling', 'webhook'])
+    parser.add_argument('--updates', type=int, default=2000, help='Обновлений на режим')
+    parser.add_argument('--rate', type=float, default=500, help='Обновлений в секунду (0 - все сразу)')
+    parser.add_argument('--max-in-flight', type=int, default=UPDATES_MAX_IN_FLIGHT, help='Одновременно обрабатываемых обновлений')
+    parser.add_argument('--connections', type=int, default=40, help='Одновременных запросов к вебхуку (max_connections у Telegram)')
+    parser.add_argument('--latency', type=float, default=0.03, help='Средняя задержка ответа Bot API (сек)')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Разброс задержки Bot API (сек)')
+    parser.add_argument('--api-port', type=int, default=8091, help='Порт заглушки Bot API')
+    parser.add_argument('--webhook-port', type=int, default=8092, help='Порт сервера вебхука')
+    parser.add_argument('--timeout', type=float, default=30, help='Сколько ждать ответы после отправки последнего обновления (сек)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    print_results(asyncio.run(run_benchmark(args)))
+
+
+if __name__ == '__main__':
+    main()
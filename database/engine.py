@@ -1,19 +1,80 @@
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from database.models import Base
-from config import DB_URL
+from database.migrations import run_migrations
+from config import (
+    DB_URL,
+    DB_ENGINE_PROFILE,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_PRE_PING,
+    DB_STATEMENT_CACHE_SIZE,
+    SQLITE_JOURNAL_MODE,
+    SQLITE_SYNCHRONOUS,
+    SQLITE_MMAP_SIZE,
+    SQLITE_CACHE_SIZE,
+    SQLITE_TEMP_STORE,
+    SQLITE_BUSY_TIMEOUT,
+)
 
 # Проверяем наличие переменной окружения
 if not DB_URL:
     raise ValueError("DB_URL environment variable is not set")
 
-engine = create_async_engine(DB_URL, echo=False)
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Настраивает каждое новое соединение SQLite"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA temp_store={SQLITE_TEMP_STORE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.close()
+
+def build_engine(db_url: str = DB_URL, profile: str = DB_ENGINE_PROFILE) -> AsyncEngine:
+    """
+    Создает движок БД с выбранным профилем настроек
+
+    Args:
+        db_url: URL базы данных
+        profile: tuned - пул и настройки драйвера из config (PRAGMA для SQLite,
+            кэш подготовленных запросов для asyncpg), default - настройки драйвера по умолчанию
+
+    Returns:
+        AsyncEngine: Движок БД
+    """
+    if profile == 'default':
+        return create_async_engine(db_url, echo=False)
+    url = make_url(db_url)
+    options = {'pool_pre_ping': DB_POOL_PRE_PING}
+    # Для БД в памяти SQLAlchemy использует пул без размеров
+    if url.database not in (None, '', ':memory:'):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    if url.get_backend_name() == 'postgresql':
+        # Кэш asyncpg и кэш подготовленных запросов диалекта SQLAlchemy
+        options['connect_args'] = {
+            'statement_cache_size': DB_STATEMENT_CACHE_SIZE,
+            'prepared_statement_cache_size': DB_STATEMENT_CACHE_SIZE,
+        }
+    engine = create_async_engine(db_url, echo=False, **options)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine.sync_engine, 'connect', apply_sqlite_pragmas)
+    return engine
+
+
+engine = build_engine()
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    await run_migrations(engine)
 
 async def drop_db():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
\ No newline at end of file
+        await conn.run_sync(Base.metadata.drop_all)
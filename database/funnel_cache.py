@@ -0,0 +1,136 @@
+from dataclasses import dataclass
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from database.models import Funnel, FunnelStep
+
+
+@dataclass(frozen=True, slots=True)
+class StepSnapshot:
+    """Неизменяемая копия этапа воронки"""
+    id: int
+    order: int
+    title: str
+    content: str
+    content_type: str
+    file_id: str | None
+    is_free: bool
+
+    @classmethod
+    def from_model(cls, step: FunnelStep) -> 'StepSnapshot':
+        return cls(
+            id=step.id,
+            order=step.order,
+            title=step.title,
+            content=step.content,
+            content_type=step.content_type,
+            file_id=step.file_id,
+            is_free=step.is_free,
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class FunnelSnapshot:
+    """
+    Неизменяемая копия воронки с этапами, отсортированными по order
+
+    Позиции этапов (как current_step в прогрессе) начинаются с 1. Индексы
+    вычисляются один раз при загрузке, чтобы обработчики отвечали за O(1):
+    next_free[i] - позиция ближайшего бесплатного этапа, начиная с i + 1 (0, если таких нет),
+    paid_gates - позиции платных этапов, на которых продвижение останавливается.
+    """
+    id: int
+    name: str
+    description: str | None
+    is_active: bool
+    steps: tuple[StepSnapshot, ...]
+    next_free: tuple[int, ...]
+    paid_gates: frozenset[int]
+
+    @classmethod
+    def from_model(cls, funnel: Funnel) -> 'FunnelSnapshot':
+        steps = tuple(StepSnapshot.from_model(step) for step in funnel.steps)
+        next_free = [0] * len(steps)
+        nearest = 0
+        for position in range(len(steps), 0, -1):
+            if steps[position - 1].is_free:
+                nearest = position
+            next_free[position - 1] = nearest
+        return cls(
+            id=funnel.id,
+            name=funnel.name,
+            description=funnel.description,
+            is_active=funnel.is_active,
+            steps=steps,
+            next_free=tuple(next_free),
+            paid_gates=frozenset(position for position, step in enumerate(steps, 1) if not step.is_free),
+        )
+
+    @property
+    def total_steps(self) -> int:
+        return len(self.steps)
+
+    def step(self, position: int) -> StepSnapshot | None:
+        """Этап на позиции position или None, если позиция вне воронки"""
+        if 1 <= position <= len(self.steps):
+            return self.steps[position - 1]
+        return None
+
+    def has_free_step_from(self, position: int) -> bool:
+        """Есть ли бесплатный этап на позиции position или дальше"""
+        return 1 <= position <= len(self.steps) and self.next_free[position - 1] != 0
+
+    def is_paid_gate(self, position: int) -> bool:
+        """Остановится ли продвижение на позиции position"""
+        return position in self.paid_gates
+
+    def is_final(self, position: int) -> bool:
+        """Заканчивается ли прохождение на позиции position: последний этап, платный этап или конец воронки"""
+        return position >= len(self.steps) or position in self.paid_gates
+
+
+class FunnelCache:
+    """
+    Кэш воронок с этапами в памяти процесса
+
+    Содержимое воронок меняет только админ, поэтому пользовательские
+    обработчики читают снимки из кэша, а функции записи в orm_query
+    сбрасывают его. Каждый сброс увеличивает версию: снимок, загрузка которого
+    началась до сброса, в кэш не попадает и не вернет старые данные.
+    """
+    def __init__(self):
+        self._funnels: dict[int, FunnelSnapshot] = {}
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    async def get(self, session: AsyncSession, funnel_id: int) -> FunnelSnapshot | None:
+        """Возвращает снимок воронки, загружая его из БД при промахе"""
+        snapshot = self._funnels.get(funnel_id)
+        if snapshot is not None:
+            return snapshot
+        version = self._version
+        funnel = await session.scalar(
+            select(Funnel)
+            .options(selectinload(Funnel.steps))
+            .where(Funnel.id == funnel_id)
+        )
+        if funnel is None:
+            return None
+        snapshot = FunnelSnapshot.from_model(funnel)
+        if version == self._version:
+            self._funnels[funnel_id] = snapshot
+        return snapshot
+
+    def invalidate(self, funnel_id: int | None = None):
+        """Сбрасывает снимок воронки (или весь кэш, если funnel_id не задан)"""
+        self._version += 1
+        if funnel_id is None:
+            self._funnels.clear()
+        else:
+            self._funnels.pop(funnel_id, None)
+
+
+funnel_cache = FunnelCache()
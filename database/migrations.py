@@ -0,0 +1,94 @@
+import logging
+from datetime import datetime
+from typing import Callable
+from sqlalchemy import Connection, inspect, select, text, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+from database.models import SchemaMigration, User
+
+# Миграции существующих БД. Новая БД сразу создается по моделям через create_all,
+# поэтому каждая миграция должна быть идемпотентной (IF NOT EXISTS, проверка колонок).
+
+
+def add_column_if_missing(conn: Connection, table: str, column: str, ddl: str):
+    """Добавляет колонку, если ее еще нет (ddl - тип и ограничения колонки)"""
+    columns = {col['name'] for col in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def dedupe_funnel_progress_and_add_unique(conn: Connection):
+    # Оставляем по одной записи прогресса на пользователя и воронку: самую продвинутую
+    conn.execute(text("""
+        DELETE FROM funnel_progress WHERE id NOT IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY user_tg_id, funnel_id
+                    ORDER BY is_completed DESC, current_step DESC, id
+                ) AS rn
+                FROM funnel_progress
+            ) ranked
+            WHERE rn = 1
+        )
+    """))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_funnel_progress_user_funnel '
+        'ON funnel_progress (user_tg_id, funnel_id)'
+    ))
+
+
+def add_bookings_user_index(conn: Connection):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_bookings_user_tg_id ON bookings (user_tg_id)'))
+
+
+def add_funnel_steps_order_index(conn: Connection):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_funnel_steps_funnel_order ON funnel_steps (funnel_id, "order")'))
+
+
+def add_users_active_partial_index(conn: Connection):
+    condition = 'is_active = 1' if conn.dialect.name == 'sqlite' else 'is_active'
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_users_active_tg_id ON users (tg_id) WHERE {condition}'))
+
+
+def add_users_last_seen(conn: Connection):
+    add_column_if_missing(conn, 'users', 'last_seen', 'TIMESTAMP')
+    # Когда пользователи заходили раньше, неизвестно: считаем их активными на момент миграции,
+    # чтобы рассылка неактивным не ушла тем, кто пользовался ботом недавно
+    conn.execute(update(User).where(User.last_seen.is_(None)).values(last_seen=datetime.now()))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_users_last_seen ON users (last_seen)'))
+
+
+def add_funnel_progress_version(conn: Connection):
+    add_column_if_missing(conn, 'funnel_progress', 'version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def add_bookings_created_at_index(conn: Connection):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_bookings_created_at ON bookings (created_at, id)'))
+
+
+# Версия, название, функция миграции. Новые миграции добавляются только в конец
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, 'funnel_progress_unique_user_funnel', dedupe_funnel_progress_and_add_unique),
+    (2, 'bookings_user_index', add_bookings_user_index),
+    (3, 'funnel_steps_funnel_order_index', add_funnel_steps_order_index),
+    (4, 'users_active_partial_index', add_users_active_partial_index),
+    (5, 'users_last_seen', add_users_last_seen),
+    (6, 'funnel_progress_version', add_funnel_progress_version),
+    (7, 'bookings_created_at_index', add_bookings_created_at_index),
+]
+
+
+async def run_migrations(engine: AsyncEngine):
+    """Применяет еще не примененные миграции по порядку, каждую в своей транзакции"""
+    async with engine.begin() as conn:
+        await conn.run_sync(SchemaMigration.__table__.create, checkfirst=True)
+        applied = set(await conn.scalars(select(SchemaMigration.version)))
+
+    for version, name, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        async with engine.begin() as conn:
+            await conn.run_sync(migration)
+            await conn.execute(
+                SchemaMigration.__table__.insert().values(version=version, name=name, applied_at=datetime.now())
+            )
+        logging.info("Применена миграция БД %d: %s", version, name)
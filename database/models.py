@@ -1,6 +1,11 @@
-from sqlalchemy import Boolean, String, Integer, Text, DateTime, ForeignKey
+from sqlalchemy import BigInteger, Boolean, String, Integer, Text, Date, DateTime, ForeignKey, Index, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from datetime import datetime
+from datetime import date, datetime
+
+
+# ID в Telegram не помещаются в 32 бита. В SQLite INTEGER и так 64-битный,
+# а первичный ключ должен остаться INTEGER, чтобы быть псевдонимом rowid
+TelegramId = BigInteger().with_variant(Integer, 'sqlite')
 
 
 class Base(DeclarativeBase):
@@ -8,11 +13,22 @@ class Base(DeclarativeBase):
 
 class User(Base):
     __tablename__ = 'users'
-
-    tg_id: Mapped[int] = mapped_column(primary_key=True, unique=True)
+    __table_args__ = (
+        # Рассылки читают и считают только активных пользователей по порядку tg_id
+        Index(
+            'ix_users_active_tg_id', 'tg_id',
+            sqlite_where=text('is_active = 1'),
+            postgresql_where=text('is_active')
+        ),
+        # Сегмент рассылки "неактивные": last_seen < now - BROADCAST_INACTIVE_DAYS
+        Index('ix_users_last_seen', 'last_seen'),
+    )
+
+    tg_id: Mapped[int] = mapped_column(TelegramId, primary_key=True, autoincrement=False, unique=True)
     is_active: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
     name: Mapped[str] = mapped_column(String, nullable=False)
     phone: Mapped[str | None] = mapped_column(String(20))
+    last_seen: Mapped[datetime | None] = mapped_column(DateTime, default=datetime.now) # Последнее обращение к боту
     # Связь с записями
     bookings: Mapped[list["Booking"]] = relationship(back_populates="user")
     # Связь с прогрессом воронки
@@ -39,16 +55,21 @@ class BroadcastSettings(Base):
 
 class Booking(Base):
     __tablename__ = 'bookings'
+    __table_args__ = (
+        Index('ix_bookings_user_tg_id', 'user_tg_id'),
+        # Постраничный просмотр записей в админке: ORDER BY created_at DESC, id DESC
+        Index('ix_bookings_created_at', 'created_at', 'id'),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    user_tg_id: Mapped[int] = mapped_column(ForeignKey('users.tg_id'), nullable=False)
+    user_tg_id: Mapped[int] = mapped_column(TelegramId, ForeignKey('users.tg_id'), nullable=False)
     service_id: Mapped[int] = mapped_column(ForeignKey('services.id'), nullable=False)
     client_name: Mapped[str] = mapped_column(String(100), nullable=False)
     phone: Mapped[str] = mapped_column(String(20), nullable=False)
     preferred_date: Mapped[str] = mapped_column(String(50), nullable=False)  # "15 января"
     preferred_time: Mapped[str] = mapped_column(String(10), nullable=False)  # "14:00"
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now(), nullable=False)
-    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now(), onupdate=datetime.now(), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
     
     # Связи
     user: Mapped["User"] = relationship(back_populates="bookings")
@@ -69,6 +90,9 @@ class Funnel(Base):
 
 class FunnelStep(Base):
     __tablename__ = 'funnel_steps'
+    __table_args__ = (
+        Index('ix_funnel_steps_funnel_order', 'funnel_id', 'order'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     funnel_id: Mapped[int] = mapped_column(ForeignKey('funnels.id'), nullable=False)
@@ -85,16 +109,98 @@ class FunnelStep(Base):
 
 class FunnelProgress(Base):
     __tablename__ = 'funnel_progress'
+    __table_args__ = (
+        # Один прогресс на пользователя и воронку
+        Index('uq_funnel_progress_user_funnel', 'user_tg_id', 'funnel_id', unique=True),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    user_tg_id: Mapped[int] = mapped_column(ForeignKey('users.tg_id'), nullable=False)
+    user_tg_id: Mapped[int] = mapped_column(TelegramId, ForeignKey('users.tg_id'), nullable=False)
     funnel_id: Mapped[int] = mapped_column(ForeignKey('funnels.id'), nullable=False)
     current_step: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
     is_completed: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now())
     completed_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     last_activity: Mapped[datetime] = mapped_column(DateTime, default=datetime.now())
+    version: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False) # Увеличивается при каждом изменении этапа
 
     # Связи
     user: Mapped["User"] = relationship(back_populates="funnel_progress")
-    funnel: Mapped["Funnel"] = relationship()
\ No newline at end of file
+    funnel: Mapped["Funnel"] = relationship()
+
+class FunnelStat(Base):
+    # Счетчики событий воронки по дням, обновляются в одной транзакции с прогрессом.
+    # step = 0 - счетчики всей воронки (started, completed), step > 0 - этапа (reached, paid_gate_hits)
+    __tablename__ = 'funnel_stats'
+    __table_args__ = (
+        Index('uq_funnel_stats_funnel_day_step', 'funnel_id', 'day', 'step', unique=True),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    funnel_id: Mapped[int] = mapped_column(ForeignKey('funnels.id'), nullable=False)
+    day: Mapped[date] = mapped_column(Date, nullable=False)
+    step: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    started: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False) # Начали курс (в том числе заново)
+    reached: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False) # Перешли на этап
+    completed: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False) # Завершили курс (последний или платный этап)
+    paid_gate_hits: Mapped[int] = mapped_column(Integer, default=0, server_default='0', nullable=False) # Остановились на платном этапе
+
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    method: Mapped[str] = mapped_column(String(30), nullable=False) # Метод бота: "send_message", "send_video"...
+    payload: Mapped[str] = mapped_column(Text, nullable=False) # JSON с аргументами метода
+    content_type: Mapped[str] = mapped_column(String(50), nullable=False) # "кастомным текстом", "видео"...
+    status: Mapped[str] = mapped_column(String(20), default='pending', nullable=False) # scheduled / pending / running / done / cancelled
+    admin_chat_id: Mapped[int | None] = mapped_column(TelegramId) # Чат, в котором показывается прогресс рассылки
+    # Чекпоинт: все получатели с tg_id <= last_tg_id уже обработаны
+    last_tg_id: Mapped[int | None] = mapped_column(TelegramId)
+    # JSON со списком обработанных получателей дальше чекпоинта
+    done_ahead: Mapped[str | None] = mapped_column(Text)
+    success_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    failed_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    deactivated_count: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    scheduled_at: Mapped[datetime | None] = mapped_column(DateTime) # Время запуска запланированной рассылки
+    segment: Mapped[str | None] = mapped_column(String(30)) # Сегмент аудитории (None - все активные)
+    segment_funnel_id: Mapped[int | None] = mapped_column(Integer) # Воронка для сегментов по воронке
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, nullable=False)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime)
+
+
+class BroadcastDelivery(Base):
+    __tablename__ = 'broadcast_deliveries'
+    __table_args__ = (
+        # Перцентили задержки и разбивка по ошибкам считаются в рамках одной рассылки
+        Index('ix_broadcast_deliveries_job_latency', 'job_id', 'latency_ms'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    job_id: Mapped[int] = mapped_column(ForeignKey('broadcast_jobs.id'), nullable=False)
+    tg_id: Mapped[int] = mapped_column(TelegramId, nullable=False)
+    status: Mapped[str] = mapped_column(String(20), nullable=False) # sent / blocked / failed
+    error_code: Mapped[str | None] = mapped_column(String(100)) # "Forbidden: bot was blocked by the user"
+    latency_ms: Mapped[int | None] = mapped_column(Integer) # Время запроса к Telegram
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, nullable=False)
+
+
+class MediaFile(Base):
+    # file_id загруженных в Telegram локальных файлов (start.webp и т.п.), чтобы не загружать их повторно
+    __tablename__ = 'media_files'
+    __table_args__ = (
+        Index('uq_media_files_hash_type', 'content_hash', 'media_type', unique=True),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=False) # sha256 содержимого файла
+    media_type: Mapped[str] = mapped_column(String(20), nullable=False) # photo / video / document / animation
+    file_id: Mapped[str] = mapped_column(String(255), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, nullable=False)
+
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False) # Номер миграции из database/migrations.py
+    name: Mapped[str] = mapped_column(String(100), nullable=False)
+    applied_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, nullable=False)
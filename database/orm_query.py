@@ -1,30 +1,62 @@
+import json
 import logging
-from sqlalchemy import exc, select, insert, update, delete
-from database.models import User, BroadcastSettings, Booking, Funnel, FunnelStep, FunnelProgress
+from sqlalchemy import exc, exists, func, literal, select, insert, update, delete, tuple_
+from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.dialects import postgresql, sqlite
+from database.models import User, BroadcastSettings, BroadcastJob, BroadcastDelivery, Booking, Funnel, FunnelStep, FunnelProgress, FunnelStat, MediaFile
+from database.funnel_cache import funnel_cache
 from aiogram.types import Message
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator
+from config import BROADCAST_INACTIVE_DAYS, LAST_SEEN_UPDATE_INTERVAL, MAX_BOOKINGS_PER_USER
 
 
+def dialect_insert(session: AsyncSession, model):
+    """INSERT текущего диалекта БД с поддержкой ON CONFLICT (PostgreSQL или SQLite)"""
+    if session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
 async def get_or_create_user(session: AsyncSession, user_tg_id: int, user_name: str) -> User:
-    """Получает пользователя из БД или создает нового. Возвращает объект пользователя."""
-    try: 
+    """Получает пользователя из БД или создает нового. Возвращает объект пользователя.
+
+    Существующий пользователь без изменений обходится одним SELECT без транзакции записи.
+    Новый или изменившийся пользователь записывается одним INSERT ... ON CONFLICT DO UPDATE
+    с RETURNING, который обновляет строку, только если изменилось имя, пользователь
+    был деактивирован или last_seen старше LAST_SEEN_UPDATE_INTERVAL.
+    """
+    try:
+        now = datetime.now()
+        seen_before = now - timedelta(seconds=LAST_SEEN_UPDATE_INTERVAL)
         current_user = await session.get(User, user_tg_id)
-        if current_user is None:
-            # Создаем нового пользователя
-            current_user = User(tg_id=user_tg_id, name=user_name)
-            session.add(current_user)
-            await session.commit()
-            return current_user
-        else:
-            # Обновляем имя если изменилось и активируем пользователя
-            if current_user.name != user_name:
-                current_user.name = user_name
-            if not current_user.is_active:
-                current_user.is_active = True
-            await session.commit()
+        if (
+            current_user is not None
+            and current_user.is_active
+            and current_user.name == user_name
+            and current_user.last_seen is not None
+            and current_user.last_seen >= seen_before
+        ):
             return current_user
+
+        stmt = dialect_insert(session, User).values(tg_id=user_tg_id, name=user_name, is_active=True, last_seen=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.tg_id],
+            set_={'name': stmt.excluded.name, 'is_active': True, 'last_seen': stmt.excluded.last_seen},
+            where=(
+                User.name.is_distinct_from(stmt.excluded.name)
+                | (User.is_active == False)
+                | User.last_seen.is_(None)
+                | (User.last_seen < seen_before)
+            )
+        ).returning(User)
+        current_user = await session.scalar(stmt, execution_options={'populate_existing': True})
+        await session.commit()
+        if current_user is None:
+            # Строку уже обновил параллельный запрос, условие WHERE не выполнилось
+            current_user = await session.get(User, user_tg_id, populate_existing=True)
+        return current_user
     except Exception as e:
         logging.error(f"Ошибка при работе с пользователем {user_tg_id}: {str(e)}")
         raise
@@ -37,10 +69,148 @@ async def deactivate_user(session: AsyncSession, user_tg_id: int):
         current_user.is_active = False
         await session.commit()
 
-async def get_active_users(session: AsyncSession):
-    """Получает всех активных пользователей для рассылки"""
-    users = await session.scalars(select(User).where(User.is_active == True))
-    return list(users)
+async def deactivate_users(session: AsyncSession, user_tg_ids: list[int]):
+    """Деактивирует пачку пользователей одним UPDATE (недоступные при рассылке)"""
+    if not user_tg_ids:
+        return
+    await session.execute(
+        update(User)
+        .where(User.tg_id.in_(user_tg_ids))
+        .values(is_active=False)
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+
+# Сегменты рассылки, для которых нужно выбрать воронку
+FUNNEL_SEGMENTS = ('funnel_not_completed', 'funnel_paid_step')
+
+def get_segment_condition(segment: str | None, funnel_id: int | None = None) -> ColumnElement[bool] | None:
+    """Условие отбора пользователей сегмента рассылки (None - все активные)
+
+    Связанные таблицы проверяются коррелированными EXISTS по user_tg_id,
+    поэтому сегмент остается одним запросом к users без дублей строк.
+    """
+    if segment is None or segment == 'all':
+        return None
+    if segment == 'funnel_not_completed':
+        return exists().where(
+            FunnelProgress.user_tg_id == User.tg_id,
+            FunnelProgress.funnel_id == funnel_id,
+            FunnelProgress.is_completed == False
+        )
+    if segment == 'funnel_paid_step':
+        # Дальше платного этапа пройти нельзя, поэтому достаточно платного этапа с order <= current_step
+        query = (
+            select(FunnelProgress.id)
+            .join(FunnelStep, FunnelStep.funnel_id == FunnelProgress.funnel_id)
+            .where(FunnelProgress.user_tg_id == User.tg_id)
+            .where(FunnelStep.is_free == False)
+            .where(FunnelStep.order <= FunnelProgress.current_step)
+        )
+        if funnel_id is not None:
+            query = query.where(FunnelProgress.funnel_id == funnel_id)
+        return query.exists()
+    if segment == 'has_booking':
+        return exists().where(Booking.user_tg_id == User.tg_id)
+    if segment == 'inactive':
+        return User.last_seen < datetime.now() - timedelta(days=BROADCAST_INACTIVE_DAYS)
+    if segment == 'has_phone':
+        return User.phone.is_not(None)
+    raise ValueError(f"Неизвестный сегмент рассылки: {segment}")
+
+async def touch_user_last_seen(session: AsyncSession, user_tg_id: int):
+    """Обновляет users.last_seen, если он старше LAST_SEEN_UPDATE_INTERVAL"""
+    now = datetime.now()
+    await session.execute(
+        update(User)
+        .where(User.tg_id == user_tg_id)
+        .where(User.last_seen.is_(None) | (User.last_seen < now - timedelta(seconds=LAST_SEEN_UPDATE_INTERVAL)))
+        .values(last_seen=now)
+    )
+    await session.commit()
+
+async def count_active_users(
+    session: AsyncSession,
+    after_tg_id: int | None = None,
+    condition: ColumnElement[bool] | None = None
+) -> int:
+    """Считает активных пользователей (с tg_id больше after_tg_id и из сегмента condition, если заданы)"""
+    query = select(func.count()).select_from(User).where(User.is_active == True)
+    if after_tg_id is not None:
+        query = query.where(User.tg_id > after_tg_id)
+    if condition is not None:
+        query = query.where(condition)
+    return await session.scalar(query)
+
+async def stream_active_user_ids(
+    session: AsyncSession,
+    chunk_size: int = 1000,
+    after_tg_id: int | None = None,
+    condition: ColumnElement[bool] | None = None
+) -> AsyncIterator[list[int]]:
+    """Отдает tg_id активных пользователей для рассылки пачками (keyset-пагинация по tg_id)"""
+    last_tg_id = after_tg_id
+    while True:
+        query = select(User.tg_id).where(User.is_active == True).order_by(User.tg_id).limit(chunk_size)
+        if condition is not None:
+            query = query.where(condition)
+        if last_tg_id is not None:
+            query = query.where(User.tg_id > last_tg_id)
+        chunk = list(await session.scalars(query))
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_tg_id = chunk[-1]
+
+def get_user_filter_condition(user_filter: str) -> ColumnElement[bool] | None:
+    """Условие фильтра списка пользователей в админке (None - все пользователи)"""
+    if user_filter == 'all':
+        return None
+    if user_filter == 'active':
+        return User.is_active == True
+    if user_filter == 'inactive':
+        return User.is_active == False
+    if user_filter == 'phone':
+        return User.phone.is_not(None)
+    raise ValueError(f"Неизвестный фильтр пользователей: {user_filter}")
+
+async def count_users(session: AsyncSession, condition: ColumnElement[bool] | None = None) -> int:
+    """Считает пользователей (из фильтра condition, если задан)"""
+    query = select(func.count()).select_from(User)
+    if condition is not None:
+        query = query.where(condition)
+    return await session.scalar(query)
+
+async def get_users_page(
+    session: AsyncSession,
+    limit: int,
+    after_tg_id: int | None = None,
+    before_tg_id: int | None = None,
+    condition: ColumnElement[bool] | None = None
+) -> tuple[list[User], bool]:
+    """Страница пользователей по возрастанию tg_id (keyset-пагинация)
+
+    Страница читается после after_tg_id или, при листании назад, перед before_tg_id.
+    Возвращает пользователей и признак, что в направлении листания есть еще страница:
+    для этого читается одна лишняя строка вместо подсчета смещения.
+    """
+    query = select(User).limit(limit + 1)
+    if condition is not None:
+        query = query.where(condition)
+    if before_tg_id is not None:
+        query = query.where(User.tg_id < before_tg_id).order_by(User.tg_id.desc())
+    else:
+        if after_tg_id is not None:
+            query = query.where(User.tg_id > after_tg_id)
+        query = query.order_by(User.tg_id)
+    users = list(await session.scalars(query))
+    has_more = len(users) > limit
+    users = users[:limit]
+    if before_tg_id is not None:
+        users.reverse()
+    return users, has_more
 
 async def get_or_create_broadcast_settings(session: AsyncSession) -> BroadcastSettings:
     """Получает настройки рассылки админа или создает новые"""
@@ -60,6 +230,132 @@ async def update_default_broadcast_text(session: AsyncSession, new_text: str):
     return settings
 
 
+async def create_broadcast_job(
+    session: AsyncSession,
+    method: str,
+    content_type: str,
+    payload: dict,
+    admin_chat_id: int | None = None,
+    scheduled_at: datetime | None = None,
+    segment: str | None = None,
+    segment_funnel_id: int | None = None
+) -> BroadcastJob:
+    """Создает задачу рассылки (запланированную, если передано scheduled_at)"""
+    job = BroadcastJob(
+        method=method,
+        content_type=content_type,
+        payload=json.dumps(payload, ensure_ascii=False),
+        admin_chat_id=admin_chat_id,
+        scheduled_at=scheduled_at,
+        segment=segment,
+        segment_funnel_id=segment_funnel_id,
+        status='scheduled' if scheduled_at else 'pending'
+    )
+    session.add(job)
+    await session.commit()
+    return job
+
+async def get_unfinished_broadcast_jobs(session: AsyncSession) -> list[BroadcastJob]:
+    """Получает рассылки, которые не были завершены (например, из-за перезапуска бота)"""
+    jobs = await session.scalars(
+        select(BroadcastJob)
+        .where(BroadcastJob.status.in_(('pending', 'running')))
+        .order_by(BroadcastJob.id)
+    )
+    return list(jobs)
+
+async def get_scheduled_broadcast_jobs(session: AsyncSession) -> list[BroadcastJob]:
+    """Получает запланированные рассылки, отсортированные по времени запуска"""
+    jobs = await session.scalars(
+        select(BroadcastJob)
+        .where(BroadcastJob.status == 'scheduled')
+        .order_by(BroadcastJob.scheduled_at)
+    )
+    return list(jobs)
+
+async def change_broadcast_job_status(session: AsyncSession, job_id: int, status: str, expected_status: str) -> bool:
+    """Меняет статус рассылки, только если он равен expected_status. Возвращает True при успехе"""
+    result = await session.execute(
+        update(BroadcastJob)
+        .where(BroadcastJob.id == job_id)
+        .where(BroadcastJob.status == expected_status)
+        .values(status=status)
+    )
+    await session.commit()
+    return result.rowcount > 0
+
+async def save_broadcast_checkpoint(
+    session: AsyncSession,
+    job: BroadcastJob,
+    last_tg_id: int | None,
+    done_ahead: list[int],
+    success_count: int,
+    failed_count: int,
+    deactivated_count: int,
+):
+    """Сохраняет чекпоинт рассылки, с которого ее можно продолжить после перезапуска"""
+    job.status = 'running'
+    job.last_tg_id = last_tg_id
+    job.done_ahead = json.dumps(done_ahead) if done_ahead else None
+    job.success_count = success_count
+    job.failed_count = failed_count
+    job.deactivated_count = deactivated_count
+    await session.commit()
+
+async def finish_broadcast_job(session: AsyncSession, job: BroadcastJob, status: str = 'done'):
+    """Помечает рассылку завершенной"""
+    job.status = status
+    job.done_ahead = None
+    job.finished_at = datetime.now()
+    await session.commit()
+
+
+async def add_broadcast_deliveries(session: AsyncSession, rows: list[dict]):
+    """Записывает пачку результатов доставки одним bulk insert"""
+    if not rows:
+        return
+    await session.execute(insert(BroadcastDelivery), rows)
+    await session.commit()
+
+async def get_recent_broadcast_jobs(session: AsyncSession, limit: int = 10) -> list[BroadcastJob]:
+    """Получает последние рассылки"""
+    jobs = await session.scalars(select(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(limit))
+    return list(jobs)
+
+async def get_broadcast_error_breakdown(session: AsyncSession, job_id: int) -> list[tuple[str, str | None, int]]:
+    """Количество доставок рассылки по статусу и коду ошибки"""
+    count = func.count().label('count')
+    rows = await session.execute(
+        select(BroadcastDelivery.status, BroadcastDelivery.error_code, count)
+        .where(BroadcastDelivery.job_id == job_id)
+        .group_by(BroadcastDelivery.status, BroadcastDelivery.error_code)
+        .order_by(count.desc())
+    )
+    return [tuple(row) for row in rows]
+
+async def get_broadcast_latency_percentiles(
+    session: AsyncSession,
+    job_id: int,
+    percentiles: tuple[int, ...] = (50, 90, 99)
+) -> dict[int, int]:
+    """Перцентили задержки отправки (мс), считаются по индексу (job_id, latency_ms) без выгрузки строк"""
+    base = (
+        select(BroadcastDelivery.latency_ms)
+        .where(BroadcastDelivery.job_id == job_id)
+        .where(BroadcastDelivery.latency_ms.is_not(None))
+    )
+    total = await session.scalar(select(func.count()).select_from(base.subquery()))
+    if not total:
+        return {}
+    result = {}
+    for percentile in percentiles:
+        offset = min(total - 1, total * percentile // 100)
+        result[percentile] = await session.scalar(
+            base.order_by(BroadcastDelivery.latency_ms).offset(offset).limit(1)
+        )
+    return result
+
+
 async def create_booking(
     session: AsyncSession,
     user_tg_id: int,
@@ -68,36 +364,93 @@ async def create_booking(
     phone: str,
     preferred_date: str,
     preferred_time: str,
-) -> Booking:
-    """Создает новую запись"""
+    max_bookings: int = MAX_BOOKINGS_PER_USER,
+) -> Booking | None:
+    """Создает новую запись, если у пользователя меньше max_bookings записей, иначе возвращает None
+
+    Квота проверяется в том же INSERT ... SELECT ... WHERE count < max_bookings, а строка
+    пользователя блокируется (FOR UPDATE в PostgreSQL, в SQLite запись и так одна), поэтому
+    одновременные записи одного пользователя не превысят лимит.
+    """
     try:
-        booking = Booking(
-            user_tg_id=user_tg_id,
-            service_id=service_id,
-            client_name=client_name,
-            phone=phone,
-            preferred_date=preferred_date,
-            preferred_time=preferred_time
+        await session.execute(select(User.tg_id).where(User.tg_id == user_tg_id).with_for_update())
+        user_bookings = select(func.count()).select_from(Booking).where(Booking.user_tg_id == user_tg_id).scalar_subquery()
+        booking_id = await session.scalar(
+            insert(Booking)
+            .from_select(
+                ['user_tg_id', 'service_id', 'client_name', 'phone', 'preferred_date', 'preferred_time'],
+                select(
+                    literal(user_tg_id, Booking.user_tg_id.type),
+                    literal(service_id),
+                    literal(client_name),
+                    literal(phone),
+                    literal(preferred_date),
+                    literal(preferred_time)
+                ).where(user_bookings < max_bookings)
+            )
+            .returning(Booking.id)
         )
-        session.add(booking)
         await session.commit()
-        logging.info(f"Создана запись {booking.id} для пользователя {user_tg_id}")
-        return booking
+        if booking_id is None:
+            logging.info(f"Пользователь {user_tg_id} превысил лимит записей ({max_bookings})")
+            return None
+        logging.info(f"Создана запись {booking_id} для пользователя {user_tg_id}")
+        return await session.get(Booking, booking_id)
     except Exception as e:
         logging.error(f"Ошибка создания записи для {user_tg_id}: {str(e)}")
         raise
 
 
-async def get_all_bookings(session: AsyncSession):
-    """Получает все записи (for admin)"""
-    query = select(Booking).options(selectinload(Booking.service)).order_by(Booking.created_at.desc())
-    bookings = await session.scalars(query)
-    return list(bookings)
+def get_booking_filter_conditions(
+    service_id: int | None = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None
+) -> list[ColumnElement[bool]]:
+    """Условия фильтра записей в админке: по услуге и диапазону даты создания [created_from, created_to)"""
+    conditions = []
+    if service_id is not None:
+        conditions.append(Booking.service_id == service_id)
+    if created_from is not None:
+        conditions.append(Booking.created_at >= created_from)
+    if created_to is not None:
+        conditions.append(Booking.created_at < created_to)
+    return conditions
+
+async def count_bookings(session: AsyncSession, conditions: list[ColumnElement[bool]]) -> int:
+    """Считает записи, подходящие под фильтр"""
+    return await session.scalar(select(func.count()).select_from(Booking).where(*conditions))
+
+async def get_bookings_page(
+    session: AsyncSession,
+    limit: int,
+    conditions: list[ColumnElement[bool]],
+    after: tuple[datetime, int] | None = None,
+    before: tuple[datetime, int] | None = None
+) -> tuple[list[Booking], bool]:
+    """Страница записей от новых к старым (keyset-пагинация по индексу (created_at, id))
+
+    after - (created_at, id) последней записи предыдущей страницы, before - первой записи
+    следующей страницы при листании назад. Возвращает записи и признак, что в направлении
+    листания есть еще страница.
+    """
+    key = tuple_(Booking.created_at, Booking.id)
+    query = select(Booking).options(selectinload(Booking.service)).where(*conditions).limit(limit + 1)
+    if before is not None:
+        query = query.where(key > tuple_(*before)).order_by(Booking.created_at, Booking.id)
+    else:
+        if after is not None:
+            query = query.where(key < tuple_(*after))
+        query = query.order_by(Booking.created_at.desc(), Booking.id.desc())
+    bookings = list(await session.scalars(query))
+    has_more = len(bookings) > limit
+    bookings = bookings[:limit]
+    if before is not None:
+        bookings.reverse()
+    return bookings, has_more
 
-async def get_user_bookings(session: AsyncSession, user_id: int):
-    """Получает записи пользователя по его id"""
-    user_bookings = await session.scalars(select(Booking).where(Booking.user_tg_id == user_id))
-    return len(list(user_bookings))
+async def count_user_bookings(session: AsyncSession, user_id: int) -> int:
+    """Считает записи пользователя по его id (COUNT по индексу ix_bookings_user_tg_id)"""
+    return await session.scalar(select(func.count()).select_from(Booking).where(Booking.user_tg_id == user_id))
 
 
 async def delete_booking(session: AsyncSession, booking_id: int):
@@ -117,6 +470,7 @@ async def create_funnel(session: AsyncSession, name: str, description: str = Non
     funnel = Funnel(name=name, description=description)
     session.add(funnel)
     await session.commit()
+    funnel_cache.invalidate(funnel.id)
     return funnel
 
 async def get_active_funnels(session: AsyncSession) -> list[Funnel]:
@@ -144,6 +498,7 @@ async def deactivate_or_activate_funnel(session: AsyncSession, funnel_id: int, i
     if funnel:
         funnel.is_active = is_active
         await session.commit()
+        funnel_cache.invalidate(funnel_id)
         return funnel
     return None
 
@@ -171,6 +526,7 @@ async def create_funnel_step(
         )
         session.add(step)
         await session.commit()
+        funnel_cache.invalidate(funnel_id)
         return step
     except Exception:
         logging.exception(f"Ошибка создания {order} этапа воронки {funnel_id}")
@@ -192,23 +548,32 @@ async def start_user_funnel(session: AsyncSession, user_tg_id: int, funnel_id: i
         if existing_progress:
             return existing_progress
         
-        # Создаем новый прогресс
-        progress = FunnelProgress(
-            user_tg_id=user_tg_id,
-            funnel_id=funnel_id,
-            current_step=1,
+        # Создаем новый прогресс. Параллельный старт той же воронки не упадет
+        # на уникальном индексе (user_tg_id, funnel_id), а вернет уже созданный прогресс
+        now = datetime.now()
+        result = await session.execute(
+            dialect_insert(session, FunnelProgress)
+            .values(user_tg_id=user_tg_id, funnel_id=funnel_id, current_step=1, started_at=now, last_activity=now)
+            .on_conflict_do_nothing(index_elements=['user_tg_id', 'funnel_id'])
         )
-        session.add(progress)
+        if result.rowcount:
+            await bump_funnel_stats(session, funnel_id, {0: {'started': 1}, 1: {'reached': 1}})
         await session.commit()
-        return progress
+        return await get_user_funnel_progress(session, user_tg_id, funnel_id)
     except Exception:
         logging.exception(f"Ошибка начала воронки {funnel_id} для Пользователя: {user_tg_id}")
 
 
-async def advance_user_funnel(session: AsyncSession, user_tg_id: int, funnel_id: int) -> FunnelProgress:
-    """Переходит к следующему этапу воронки"""
+async def advance_user_funnel(
+    session: AsyncSession,
+    user_tg_id: int,
+    funnel_id: int,
+    progress: FunnelProgress | None = None
+) -> FunnelProgress:
+    """Переходит к следующему этапу воронки (progress - уже прочитанный обработчиком прогресс)"""
     try:
-        progress = await get_user_funnel_progress(session, user_tg_id, funnel_id)
+        if progress is None:
+            progress = await get_user_funnel_progress(session, user_tg_id, funnel_id)
         if not progress:
             logging.warning(
                     f"Прогресс не найден: user_id={user_tg_id}, "
@@ -216,36 +581,56 @@ async def advance_user_funnel(session: AsyncSession, user_tg_id: int, funnel_id:
                 )
             return None
         
-        # Получаем воронку с этапами
-        funnel = await get_funnel_with_steps(session, funnel_id)
+        # Получаем воронку с этапами из кэша
+        funnel = await funnel_cache.get(session, funnel_id)
         if not funnel or not funnel.steps:
             return progress
         
-        total_steps = len(funnel.steps)
+        total_steps = funnel.total_steps
         
         # Проверяем, что текущий этап существует
-        if progress.current_step > total_steps:
+        if funnel.step(progress.current_step) is None:
             return progress
         
-        # Получаем текущий этап
-        current_step = funnel.steps[progress.current_step - 1]
-        
         # Если текущий этап платный, не переходим дальше
-        if not current_step.is_free:
+        if funnel.is_paid_gate(progress.current_step):
             return progress
         
-        # Переходим к следующему этапу
-        progress.current_step += 1
-        progress.last_activity = datetime.now()
-        
+        # Переходим к следующему этапу через compare-and-set: UPDATE изменит строку, только если
+        # ее версия не поменялась после чтения. При двойном нажатии "Следующий урок" этап
+        # переключит только один из запросов, второй получит уже обновленный прогресс
+        now = datetime.now()
+        next_step = progress.current_step + 1
+        was_completed = progress.is_completed
+        values = {
+            'current_step': FunnelProgress.current_step + 1,
+            'version': FunnelProgress.version + 1,
+            'last_activity': now,
+        }
         # Проверяем, достигли ли мы конца курса (только если это последний этап)
-        if progress.current_step > total_steps:
+        if next_step > total_steps:
             # Курс завершен - мы прошли все этапы
-            progress.is_completed = True
-            progress.completed_at = datetime.now()
+            values['is_completed'] = True
+            values['completed_at'] = now
         
+        updated_progress = await session.scalar(
+            update(FunnelProgress)
+            .where(FunnelProgress.id == progress.id)
+            .where(FunnelProgress.version == progress.version)
+            .values(**values)
+            .returning(FunnelProgress),
+            execution_options={'populate_existing': True}
+        )
+        if updated_progress is not None:
+            if next_step <= total_steps:
+                await bump_funnel_stats(session, funnel_id, {next_step: {'reached': 1}})
+            elif not was_completed:
+                await bump_funnel_stats(session, funnel_id, {0: {'completed': 1}})
         await session.commit()
-        return progress
+        if updated_progress is None:
+            # Версия уже изменилась, этап переключил параллельный запрос
+            updated_progress = await session.get(FunnelProgress, progress.id, populate_existing=True)
+        return updated_progress
     except Exception as e:
         logging.exception(
             f"Ошибка перехода этапа: user_id={user_tg_id}, "
@@ -255,6 +640,49 @@ async def advance_user_funnel(session: AsyncSession, user_tg_id: int, funnel_id:
         raise
 
 
+async def complete_user_funnel(session: AsyncSession, progress: FunnelProgress, paid_gate: int | None = None) -> bool:
+    """Отмечает курс завершенным (на последнем этапе или на платном этапе paid_gate)
+
+    Флаг ставится условным UPDATE ... WHERE is_completed = false, поэтому повторный показ
+    того же этапа или параллельный запрос не посчитают завершение дважды.
+    Возвращает True, если курс завершен этим вызовом.
+    """
+    completed = await session.scalar(
+        update(FunnelProgress)
+        .where(FunnelProgress.id == progress.id)
+        .where(FunnelProgress.is_completed == False)
+        .values(is_completed=True, completed_at=datetime.now())
+        .returning(FunnelProgress),
+        execution_options={'populate_existing': True}
+    )
+    if completed is not None:
+        counters = {0: {'completed': 1}}
+        if paid_gate is not None:
+            counters[paid_gate] = {'paid_gate_hits': 1}
+        await bump_funnel_stats(session, progress.funnel_id, counters)
+    await session.commit()
+    return completed is not None
+
+async def uncomplete_user_funnel(session: AsyncSession, progress: FunnelProgress) -> bool:
+    """Снимает флаг завершения (например, после добавления новых этапов)
+
+    Завершение вычитается из счетчика completed за день, в который оно было засчитано,
+    поэтому повторное завершение не считается дважды. Возвращает True, если флаг снят этим вызовом.
+    """
+    completed_day = (progress.completed_at or progress.last_activity).date()
+    uncompleted = await session.scalar(
+        update(FunnelProgress)
+        .where(FunnelProgress.id == progress.id)
+        .where(FunnelProgress.is_completed == True)
+        .values(is_completed=False, completed_at=None)
+        .returning(FunnelProgress),
+        execution_options={'populate_existing': True}
+    )
+    if uncompleted is not None:
+        await bump_funnel_stats(session, progress.funnel_id, {0: {'completed': -1}}, day=completed_day)
+    await session.commit()
+    return uncompleted is not None
+
 async def reset_user_funnel_progress(session: AsyncSession, user_tg_id: int, funnel_id: int) -> FunnelProgress:
     """Сбрасывает прогресс пользователя по воронке к началу"""
     progress = await get_user_funnel_progress(session, user_tg_id, funnel_id)
@@ -263,18 +691,156 @@ async def reset_user_funnel_progress(session: AsyncSession, user_tg_id: int, fun
         progress.is_completed = False
         progress.completed_at = None
         progress.last_activity = datetime.now()
+        # Новая версия не даст параллельному advance_user_funnel продвинуть сброшенный прогресс
+        progress.version += 1
+        await bump_funnel_stats(session, funnel_id, {0: {'started': 1}, 1: {'reached': 1}})
         await session.commit()
     return progress
 
 async def delete_funnel(session: AsyncSession, funnel_id: int):
     """Удаляет воронку и все связанные с ней данные"""
-    # Удаляем прогресс пользователей
+    # Удаляем прогресс пользователей и статистику
     await session.execute(delete(FunnelProgress).where(FunnelProgress.funnel_id == funnel_id))
+    await session.execute(delete(FunnelStat).where(FunnelStat.funnel_id == funnel_id))
     # Удаляем этапы
     await session.execute(delete(FunnelStep).where(FunnelStep.funnel_id == funnel_id))
     # Удаляем воронку
     await session.execute(delete(Funnel).where(Funnel.id == funnel_id))
     await session.commit()
+    funnel_cache.invalidate(funnel_id)
+
+# Счетчики статистики воронок (таблица funnel_stats)
+FUNNEL_STAT_COUNTERS = ('started', 'reached', 'completed', 'paid_gate_hits')
+
+async def bump_funnel_stats(session: AsyncSession, funnel_id: int, counters: dict[int, dict[str, int]], day: date | None = None):
+    """Увеличивает счетчики воронки за день day (по умолчанию сегодня): {этап (0 - вся воронка): {счетчик: прирост}}
+
+    Все строки обновляются одним INSERT ... ON CONFLICT DO UPDATE в текущей транзакции,
+    commit выполняет вызывающая функция вместе с изменением прогресса.
+    """
+    day = day or date.today()
+    rows = [
+        {'funnel_id': funnel_id, 'day': day, 'step': step, **{name: values.get(name, 0) for name in FUNNEL_STAT_COUNTERS}}
+        for step, values in counters.items()
+    ]
+    stmt = dialect_insert(session, FunnelStat).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['funnel_id', 'day', 'step'],
+        set_={name: getattr(FunnelStat, name) + getattr(stmt.excluded, name) for name in FUNNEL_STAT_COUNTERS}
+    )
+    await session.execute(stmt)
+
+async def get_funnel_stats(session: AsyncSession, funnel_id: int, since: date | None = None) -> dict[int, dict[str, int]]:
+    """Суммы счетчиков воронки по этапам (с даты since, если задана): {этап: {счетчик: значение}}"""
+    query = (
+        select(FunnelStat.step, *(func.sum(getattr(FunnelStat, name)) for name in FUNNEL_STAT_COUNTERS))
+        .where(FunnelStat.funnel_id == funnel_id)
+        .group_by(FunnelStat.step)
+    )
+    if since is not None:
+        query = query.where(FunnelStat.day >= since)
+    return {
+        step: dict(zip(FUNNEL_STAT_COUNTERS, (int(value or 0) for value in values)))
+        for step, *values in await session.execute(query)
+    }
+
+async def get_funnel_participants(session: AsyncSession, funnel_id: int) -> tuple[int, int]:
+    """Участники воронки по funnel_progress (по строке на пользователя): (всего, завершили курс)"""
+    total, completed = (await session.execute(
+        select(func.count(), func.count().filter(FunnelProgress.is_completed == True))
+        .where(FunnelProgress.funnel_id == funnel_id)
+    )).one()
+    return total, completed
+
+async def rebuild_funnel_stats(session: AsyncSession) -> int:
+    """Пересчитывает funnel_stats по текущему прогрессу пользователей, возвращает число строк
+
+    История событий не хранится, поэтому пересчет восстанавливает счетчики по состоянию:
+    старт - в день started_at, переходы на этапы до текущего - в день last_activity,
+    завершение и остановка на платном этапе - в день completed_at. Перезапуски курса,
+    прошедшие до пересчета, не восстанавливаются.
+    """
+    totals: dict[tuple[int, date, int], dict[str, int]] = {}
+
+    def add(funnel_id: int, day, step: int, name: str, count: int):
+        if isinstance(day, str):  # SQLite возвращает date() строкой
+            day = date.fromisoformat(day)
+        key = (funnel_id, day, step)
+        totals.setdefault(key, dict.fromkeys(FUNNEL_STAT_COUNTERS, 0))[name] += count
+
+    started_day = func.date(FunnelProgress.started_at)
+    for funnel_id, day, count in await session.execute(
+        select(FunnelProgress.funnel_id, started_day, func.count()).group_by(FunnelProgress.funnel_id, started_day)
+    ):
+        add(funnel_id, day, 0, 'started', count)
+
+    activity_day = func.date(FunnelProgress.last_activity)
+    for funnel_id, step, day, count in await session.execute(
+        select(FunnelProgress.funnel_id, FunnelStep.order, activity_day, func.count())
+        .join(FunnelStep, FunnelStep.funnel_id == FunnelProgress.funnel_id)
+        .where(FunnelStep.order <= FunnelProgress.current_step)
+        .group_by(FunnelProgress.funnel_id, FunnelStep.order, activity_day)
+    ):
+        add(funnel_id, day, step, 'reached', count)
+
+    completed_day = func.date(func.coalesce(FunnelProgress.completed_at, FunnelProgress.last_activity))
+    for funnel_id, day, count in await session.execute(
+        select(FunnelProgress.funnel_id, completed_day, func.count())
+        .where(FunnelProgress.is_completed == True)
+        .group_by(FunnelProgress.funnel_id, completed_day)
+    ):
+        add(funnel_id, day, 0, 'completed', count)
+
+    for funnel_id, step, day, count in await session.execute(
+        select(FunnelProgress.funnel_id, FunnelStep.order, completed_day, func.count())
+        .join(FunnelStep, FunnelStep.funnel_id == FunnelProgress.funnel_id)
+        .where(FunnelStep.order == FunnelProgress.current_step)
+        .where(FunnelStep.is_free == False)
+        .where(FunnelProgress.is_completed == True)
+        .group_by(FunnelProgress.funnel_id, FunnelStep.order, completed_day)
+    ):
+        add(funnel_id, day, step, 'paid_gate_hits', count)
+
+    await session.execute(delete(FunnelStat))
+    rows = [
+        {'funnel_id': funnel_id, 'day': day, 'step': step, **counters}
+        for (funnel_id, day, step), counters in totals.items()
+    ]
+    if rows:
+        await session.execute(insert(FunnelStat), rows)
+    await session.commit()
+    return len(rows)
+
+async def get_completed_funnel_users_page(
+    session: AsyncSession,
+    funnel_id: int,
+    limit: int,
+    after_id: int | None = None,
+    before_id: int | None = None
+) -> tuple[list[tuple[int, str, str | None]], bool]:
+    """Страница завершивших воронку: (id прогресса, имя, телефон), keyset-пагинация по id прогресса
+
+    Возвращает строки и признак, что в направлении листания есть еще страница.
+    """
+    query = (
+        select(FunnelProgress.id, User.name, User.phone)
+        .join(User, User.tg_id == FunnelProgress.user_tg_id)
+        .where(FunnelProgress.funnel_id == funnel_id)
+        .where(FunnelProgress.is_completed == True)
+        .limit(limit + 1)
+    )
+    if before_id is not None:
+        query = query.where(FunnelProgress.id < before_id).order_by(FunnelProgress.id.desc())
+    else:
+        if after_id is not None:
+            query = query.where(FunnelProgress.id > after_id)
+        query = query.order_by(FunnelProgress.id)
+    rows = [tuple(row) for row in await session.execute(query)]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before_id is not None:
+        rows.reverse()
+    return rows, has_more
 
 async def get_user_all_funnel_progress(session: AsyncSession, user_tg_id: int) -> list[FunnelProgress]:
     """Получает все прогрессы пользователя по воронкам"""
@@ -301,4 +867,34 @@ async def update_phone(session: AsyncSession, user_tg_id: int, phone_number: str
         logging.info("Пользователь: %d обновил номер телефона: %s", user_tg_id, phone_number)
         return current_user
     else:
-        return current_user
\ No newline at end of file
+        return current_user
+
+
+async def get_media_file_id(session: AsyncSession, content_hash: str, media_type: str) -> str | None:
+    """file_id ранее загруженного файла с таким содержимым или None"""
+    return await session.scalar(
+        select(MediaFile.file_id)
+        .where(MediaFile.content_hash == content_hash, MediaFile.media_type == media_type)
+    )
+
+
+async def save_media_file_id(session: AsyncSession, content_hash: str, media_type: str, file_id: str):
+    """Сохраняет file_id загруженного файла, заменяя прежний"""
+    stmt = dialect_insert(session, MediaFile).values(
+        content_hash=content_hash, media_type=media_type, file_id=file_id, created_at=datetime.now()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['content_hash', 'media_type'],
+        set_={'file_id': stmt.excluded.file_id, 'created_at': stmt.excluded.created_at}
+    )
+    await session.execute(stmt)
+    await session.commit()
+
+
+async def delete_media_file_id(session: AsyncSession, content_hash: str, media_type: str, file_id: str):
+    """Удаляет file_id, отклоненный Telegram (если его еще не заменили новым)"""
+    await session.execute(
+        delete(MediaFile)
+        .where(MediaFile.content_hash == content_hash, MediaFile.media_type == media_type, MediaFile.file_id == file_id)
+    )
+    await session.commit()
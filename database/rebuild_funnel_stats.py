@@ -0,0 +1,30 @@
+"""
+Пересчет таблицы funnel_stats по текущему прогрессу пользователей
+
+Счетчики обновляются вместе с прогрессом, поэтому пересчет нужен один раз:
+для прогресса, накопленного до появления таблицы, или после ручных правок БД.
+Таблица очищается и заполняется заново, бота на время пересчета лучше остановить.
+
+Запуск (из корня проекта):
+    python -m database.rebuild_funnel_stats
+"""
+import asyncio
+import logging
+from database.engine import create_db, engine, session_maker
+from database.orm_query import rebuild_funnel_stats
+from utils.logging_config import configure_logging
+
+
+async def main():
+    await create_db()
+    try:
+        async with session_maker() as session:
+            rows = await rebuild_funnel_stats(session)
+        logging.info("Статистика воронок пересчитана, строк: %d", rows)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    configure_logging(level=logging.INFO)
+    asyncio.run(main())
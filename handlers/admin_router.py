@@ -1,6 +1,9 @@
+import html
 import logging
+from datetime import datetime, timedelta
 from aiogram import Router, F, Bot
 from aiogram.types import InlineKeyboardMarkup, Message, CallbackQuery, InlineKeyboardButton, ReplyKeyboardRemove, ForceReply
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart, Command, and_f
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -10,7 +13,16 @@ from sqlalchemy.ext.asyncio import AsyncSession
 import keyboards.admin_kb as admin_kb
 import filters.admin_filter as Admin
 from database.models import User, Service
-from database.orm_query import get_all_bookings, delete_booking
+from database.orm_query import (
+    delete_booking,
+    get_booking_filter_conditions,
+    count_bookings,
+    get_bookings_page,
+    get_user_filter_condition,
+    count_users,
+    get_users_page
+)
+from config import ADMIN_USERS_PAGE_SIZE, ADMIN_BOOKINGS_PAGE_SIZE
 
 
 class ServiceCreation(StatesGroup):
@@ -52,25 +64,59 @@ async def cancel_broadcast_settings(message: Message, state: FSMContext):
         await message.answer('Нет активного процесса настройки.', reply_markup=ReplyKeyboardRemove())
 
 
+async def render_users_page(session: AsyncSession, user_filter: str, direction: str = 'n', cursor: int | None = None):
+    """Текст и клавиатура страницы списка пользователей"""
+    condition = get_user_filter_condition(user_filter)
+    if direction == 'p':
+        users, has_prev = await get_users_page(session, ADMIN_USERS_PAGE_SIZE, before_tg_id=cursor, condition=condition)
+        has_next = True
+    else:
+        users, has_next = await get_users_page(session, ADMIN_USERS_PAGE_SIZE, after_tg_id=cursor, condition=condition)
+        has_prev = cursor is not None
+    total = await count_users(session, condition)
+
+    text = [f"Список пользователей: <b>{admin_kb.USER_FILTERS[user_filter]}</b>\nВсего: <b>{total}</b>"]
+    for user in users:
+        status = 'Активный'
+        if not user.is_active:
+            status = 'Неактивный'
+        text.append(f"Имя пользователя: {html.escape(user.name or '')}\nID пользователя: {user.tg_id}\nCтатус пользователя: <b>{status}</b>\n"
+                    f"Телефон пользователя: {user.phone if user.phone else "<b>Не указан</b>"}")
+    if not users:
+        text.append('Пользователей не найдено')
+    reply_markup = admin_kb.get_users_page_kb(
+        user_filter,
+        users[0].tg_id if users else cursor,
+        users[-1].tg_id if users else cursor,
+        has_prev and bool(users),
+        has_next and bool(users)
+    )
+    return '\n\n'.join(text), reply_markup
+
+
 @admin_router.callback_query(F.data=='user_list')
 async def send_all(callback: CallbackQuery, session: AsyncSession):
     await callback.message.delete()
     await callback.answer('')
-    users = await session.scalars(select(User))
-    users = users.all()
-    text = ["Список пользователей"]
-    if users:
-        for user in users[:50]:
-            status = 'Активный'
-            if not user.is_active:
-                status = 'Неактивный'
-            text.append(f"Имя пользователя: {user.name}\nID пользователя: {user.tg_id}\nCтатус пользователя: <b>{status}</b>\n"
-                        f"Телефон пользователя: {user.phone if user.phone else "<b>Не указан</b>"}")
-        if len(users) > 50:
-            text.append(f"И еще <b>{len(users) - 50}</b> пользователей")
-        await callback.message.answer(text='\n\n'.join(i for i in text), reply_markup=admin_kb.admin_kb.as_markup())
-    else:
-        await callback.message.answer('Список пользователей пуст\nПопробуйте ещё раз', reply_markup=admin_kb.admin_kb.as_markup())
+    text, reply_markup = await render_users_page(session, 'all')
+    await callback.message.answer(text=text, reply_markup=reply_markup)
+
+
+@admin_router.callback_query(F.data.startswith('users_page:'))
+async def users_page(callback: CallbackQuery, session: AsyncSession):
+    # users_page:<фильтр>:<n - вперед, p - назад>:<tg_id границы страницы, 0 - с начала>
+    _, user_filter, direction, cursor = callback.data.split(':')
+    if user_filter not in admin_kb.USER_FILTERS:
+        await callback.answer('Неизвестный фильтр')
+        return
+    await callback.answer('')
+    text, reply_markup = await render_users_page(session, user_filter, direction, int(cursor) or None)
+    try:
+        await callback.message.edit_text(text=text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        # Страница не изменилась (повторное нажатие того же фильтра)
+        if 'message is not modified' not in e.message:
+            logging.warning("Не удалось показать страницу пользователей: %s", e)
 
 # FSM для создания услуг
 @admin_router.callback_query(F.data=='add_service')
@@ -192,55 +238,109 @@ async def confirm_delete(callback: CallbackQuery, state: FSMContext, session: As
     await callback.message.answer(f'Услуга <b>{service_id}</b> успешно удалена', reply_markup=admin_kb.back_to_admin.as_markup())
 
 
+# Курсор страницы записей в callback_data: время создания и id записи
+BOOKING_CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def get_booking_period_range(period: str) -> tuple[datetime | None, datetime | None]:
+    """Диапазон дат создания записей для периода фильтра"""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'today':
+        return today, None
+    if period == 'week':
+        return today - timedelta(days=7), None
+    if period == 'month':
+        return today - timedelta(days=30), None
+    return None, None
+
+
+def booking_cursor(booking) -> str:
+    return f"{booking.created_at.strftime(BOOKING_CURSOR_FORMAT)}.{booking.id}"
+
+
+def parse_booking_cursor(cursor: str) -> tuple[datetime, int] | None:
+    if cursor == '0':
+        return None
+    created_at, booking_id = cursor.split('.')
+    return datetime.strptime(created_at, BOOKING_CURSOR_FORMAT), int(booking_id)
+
+
+async def send_bookings_page(message: Message, session: AsyncSession, service_id: int, period: str, direction: str = 'n', cursor: str = '0'):
+    """Отправляет страницу записей: каждая запись отдельным сообщением с действиями, затем навигация"""
+    conditions = get_booking_filter_conditions(service_id or None, *get_booking_period_range(period))
+    key = parse_booking_cursor(cursor)
+    if direction == 'p':
+        bookings, has_prev = await get_bookings_page(session, ADMIN_BOOKINGS_PAGE_SIZE, conditions, before=key)
+        has_next = True
+    else:
+        bookings, has_next = await get_bookings_page(session, ADMIN_BOOKINGS_PAGE_SIZE, conditions, after=key)
+        has_prev = key is not None
+    total = await count_bookings(session, conditions)
+
+    for booking in bookings:
+        booking_text = f"<b>Запись #{booking.id}</b>\n"
+        booking_text += f"👤 <b>Клиент:</b> {booking.client_name}\n"
+        booking_text += f"📞 <b>Телефон:</b> {booking.phone}\n"
+        booking_text += f"🎯 <b>Услуга:</b> {booking.service.name}\n"
+        booking_text += f"💰 <b>Стоимость:</b> {booking.service.price} ₽\n"
+        booking_text += f"📅 <b>Дата:</b> {booking.preferred_date}\n"
+        booking_text += f"🕐 <b>Время:</b> {booking.preferred_time}\n"
+        booking_text += f"📝 <b>Создана:</b> {booking.created_at.strftime('%d.%m.%Y %H:%M')}\n\n"
+        
+        await message.answer(
+            booking_text, 
+            reply_markup=admin_kb.get_booking_actions_kb(booking.id)
+        )
+
+    service = await session.get(Service, service_id) if service_id else None
+    filters_text = f"{admin_kb.BOOKING_PERIODS[period]}, {service.name if service else 'все услуги'}"
+    if bookings:
+        text = (
+            f"📊 <b>Показано {len(bookings)} из {total} записей</b> ({filters_text})\n\n"
+            f"Если вы уже поработали или встреча не состоялась\n"
+            f"<b>Завершите</b> либо <b>Отмените</b> запись\n\n"
+            f"<b>При завершении</b> клиенту придет уведомление с просьбой об отзыве\n"
+            f"<b>При отмене</b> пользователю придет уведомление об отмене его записи"
+        )
+    else:
+        text = f"📋 Записей не найдено ({filters_text})"
+    await message.answer(
+        text,
+        reply_markup=admin_kb.get_bookings_page_kb(
+            service_id,
+            period,
+            booking_cursor(bookings[0]) if bookings else None,
+            booking_cursor(bookings[-1]) if bookings else None,
+            has_prev and bool(bookings),
+            has_next and bool(bookings)
+        )
+    )
+
+
 @admin_router.callback_query(F.data=='view_bookings')
 async def view_bookings(callback: CallbackQuery, session: AsyncSession):
     await callback.answer('')
     
     try:
-        # Получаем все записи
-        bookings = await get_all_bookings(session)
-        
-        if bookings:
-            # Показываем последние 10 записей
-            recent_bookings = bookings[:10]
-            
-            for booking in recent_bookings:
-                booking_text = f"<b>Запись #{booking.id}</b>\n"
-                booking_text += f"👤 <b>Клиент:</b> {booking.client_name}\n"
-                booking_text += f"📞 <b>Телефон:</b> {booking.phone}\n"
-                booking_text += f"🎯 <b>Услуга:</b> {booking.service.name}\n"
-                booking_text += f"💰 <b>Стоимость:</b> {booking.service.price} ₽\n"
-                booking_text += f"📅 <b>Дата:</b> {booking.preferred_date}\n"
-                booking_text += f"🕐 <b>Время:</b> {booking.preferred_time}\n"
-                booking_text += f"📝 <b>Создана:</b> {booking.created_at.strftime('%d.%m.%Y %H:%M')}\n\n"
-                
-                await callback.message.answer(
-                    booking_text, 
-                    reply_markup=admin_kb.get_booking_actions_kb(booking.id)
-                )
-                
-            # Информация о количестве записей
-            if len(bookings) > 10:
-                await callback.message.answer(
-                    f"📊 <b>Показано последних 10 записей из {len(bookings)}</b>\n\n"
-                    f"Для просмотра следующих записей удалите старые.",
-                    reply_markup=admin_kb.back_to_admin.as_markup()
-                )
-            else:
-                await callback.message.answer(
-                    f"📊 <b>Показано {len(bookings)} записей</b>\n\n"
-                    f"Если вы уже поработали или встреча не состоялась\n"
-                    f"<b>Завершите</b> либо <b>Отмените</b> запись\n\n"
-                    f"<b>При завершении</b> клиенту придет уведомление с просьбой об отзыве\n"
-                    f"<b>При отмене</b> пользователю придет уведомление об отмене его записи",
-                    reply_markup=admin_kb.back_to_admin.as_markup()
-                )
-
-        else:
-            await callback.message.answer(
-                '📋 Записей пока нет', 
-                reply_markup=admin_kb.admin_kb.as_markup()
-            )
+        await send_bookings_page(callback.message, session, 0, 'all')
+    except Exception as e:
+        logging.exception("Ошибка при получении записей")
+        await callback.message.answer(
+            '❌ Произошла ошибка при получении записей', 
+            reply_markup=admin_kb.admin_kb.as_markup()
+        )
+
+
+@admin_router.callback_query(F.data.startswith('bookings_page:'))
+async def bookings_page(callback: CallbackQuery, session: AsyncSession):
+    # bookings_page:<id услуги, 0 - все>:<период>:<n - старее, p - новее>:<курсор, 0 - с начала>
+    _, service_id, period, direction, cursor = callback.data.split(':')
+    if period not in admin_kb.BOOKING_PERIODS:
+        await callback.answer('Неизвестный период')
+        return
+    await callback.answer('')
+    try:
+        await send_bookings_page(callback.message, session, int(service_id), period, direction, cursor)
     except Exception as e:
         logging.exception("Ошибка при получении записей")
         await callback.message.answer(
@@ -249,6 +349,17 @@ async def view_bookings(callback: CallbackQuery, session: AsyncSession):
         )
 
 
+@admin_router.callback_query(F.data.startswith('bookings_services:'))
+async def bookings_services(callback: CallbackQuery, session: AsyncSession):
+    period = callback.data.split(':')[1]
+    await callback.answer('')
+    services = await session.scalars(select(Service).order_by(Service.name))
+    await callback.message.answer(
+        'Выберите услугу для фильтра записей:',
+        reply_markup=admin_kb.get_bookings_services_kb(services, period)
+    )
+
+
 @admin_router.callback_query(F.data.startswith('booking_cancel_'))
 async def cancel_booking(callback: CallbackQuery, session: AsyncSession, bot: Bot):
     booking_id = callback.data.split('_')[2]
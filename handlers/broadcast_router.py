@@ -1,12 +1,28 @@
+from datetime import datetime
 from aiogram import Router, F, Bot
-from aiogram.filters import Command
+from aiogram.filters import Command, StateFilter
 from aiogram.types import ForceReply, Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy.ext.asyncio import AsyncSession
 from filters.admin_filter import IsAdmin
-from database.orm_query import get_or_create_broadcast_settings, update_default_broadcast_text
-from utils.broadcast_utils import send_broadcast, format_broadcast_result
+from database.models import BroadcastJob, Funnel
+from database.orm_query import (
+    get_or_create_broadcast_settings,
+    update_default_broadcast_text,
+    create_broadcast_job,
+    get_scheduled_broadcast_jobs,
+    change_broadcast_job_status,
+    get_all_funnels,
+    get_segment_condition,
+    count_active_users,
+    FUNNEL_SEGMENTS,
+    get_recent_broadcast_jobs,
+    get_broadcast_error_breakdown,
+    get_broadcast_latency_percentiles
+)
+from utils.broadcast_jobs import BroadcastManager, describe_broadcast_job
+from utils.broadcast_scheduler import BroadcastScheduler
 import keyboards.admin_kb as admin_kb
 
 broadcast_router = Router()
@@ -28,6 +44,48 @@ class SendVideoNote(StatesGroup):
     waiting_for_note = State()
     waiting_for_confirm = State()
 
+class ScheduleBroadcast(StatesGroup):
+    waiting_for_time = State()
+
+# Состояния подтверждения рассылки, из которых можно выбрать аудиторию и запланировать отправку
+CONFIRM_STATES = (
+    BroadcastSettings.waiting_for_custom_confirm,
+    BroadcastSettings.waiting_for_default_text_confirm,
+    SendVideo.waiting_for_confirm,
+    SendVideoNote.waiting_for_confirm,
+)
+
+def get_confirmed_broadcast(state_name: str, data: dict) -> tuple[str, str, dict]:
+    """Возвращает метод, тип контента и аргументы рассылки, которую подтверждает админ"""
+    if state_name == BroadcastSettings.waiting_for_custom_confirm.state:
+        return 'send_message', 'кастомным текстом', {'text': data.get('custom_text')}
+    if state_name == BroadcastSettings.waiting_for_default_text_confirm.state:
+        return 'send_message', 'стандартным текстом', {'text': data.get('default_text')}
+    if state_name == SendVideo.waiting_for_confirm.state:
+        return 'send_video', 'видео', {'video': data.get('video'), 'caption': data.get('caption')}
+    return 'send_video_note', 'кружок', {'video_note': data.get('video_note')}
+
+async def launch_broadcast(
+    callback: CallbackQuery,
+    session: AsyncSession,
+    broadcast_manager: BroadcastManager,
+    method: str,
+    content_type: str,
+    segment: str | None = None,
+    segment_funnel_id: int | None = None,
+    **payload
+):
+    """Сохраняет рассылку и запускает ее в фоне, прогресс придет отдельным сообщением"""
+    job = await create_broadcast_job(
+        session, method, content_type, payload,
+        admin_chat_id=callback.message.chat.id,
+        segment=segment,
+        segment_funnel_id=segment_funnel_id
+    )
+    broadcast_manager.start(job.id)
+    await callback.answer('Рассылка запущена')
+    await callback.message.delete()
+
 @broadcast_router.callback_query(F.data=='broadcast_menu')
 async def broadcast_menu(callback: CallbackQuery, state: FSMContext):
     current_state = await state.get_state()
@@ -103,21 +161,18 @@ async def edit_custom_text(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer('Введите новый текст для рассылки:', reply_markup=ForceReply(selective=True, input_field_placeholder="Введите новый текст рассылки"))
 
 @broadcast_router.callback_query(F.data=='confirm_send_text', BroadcastSettings.waiting_for_custom_confirm)
-async def confirm_send_text(callback: CallbackQuery, bot: Bot, session: AsyncSession, state: FSMContext):
+async def confirm_send_text(callback: CallbackQuery, session: AsyncSession, state: FSMContext, broadcast_manager: BroadcastManager):
     data = await state.get_data()
     custom_text = data.get('custom_text')
     await state.clear()
-    success_count, failed_count = await send_broadcast(
-        bot=bot,
-        session=session,
-        send_func=bot.send_message,
+    await launch_broadcast(
+        callback, session, broadcast_manager,
+        method='send_message',
         content_type="кастомным текстом",
-        text=custom_text
+        text=custom_text,
+        segment=data.get('segment'),
+        segment_funnel_id=data.get('segment_funnel_id')
     )
-    result_text = format_broadcast_result(success_count, failed_count, "кастомным текстом", custom_text)
-    await callback.message.answer(result_text, reply_markup=admin_kb.admin_kb.as_markup())
-    await callback.message.delete()
-    await callback.answer('')
 
 @broadcast_router.message(BroadcastSettings.waiting_for_default_text)
 async def get_new_default_text(message: Message, state: FSMContext, session: AsyncSession):
@@ -149,21 +204,18 @@ async def send_default_broadcast(callback: CallbackQuery, bot: Bot, session: Asy
     )
 
 @broadcast_router.callback_query(F.data=='confirm_send_text', BroadcastSettings.waiting_for_default_text_confirm)
-async def confirm_send_text(callback: CallbackQuery, bot: Bot, session: AsyncSession, state: FSMContext):
+async def confirm_send_text(callback: CallbackQuery, session: AsyncSession, state: FSMContext, broadcast_manager: BroadcastManager):
     data = await state.get_data()
     default_text = data.get('default_text')
     await state.clear()
-    success_count, failed_count = await send_broadcast(
-        bot=bot,
-        session=session,
-        send_func=bot.send_message,
+    await launch_broadcast(
+        callback, session, broadcast_manager,
+        method='send_message',
         content_type="стандартным текстом",
-        text=default_text
+        text=default_text,
+        segment=data.get('segment'),
+        segment_funnel_id=data.get('segment_funnel_id')
     )
-    result_text = format_broadcast_result(success_count, failed_count, "стандартным текстом", default_text)
-    await callback.message.answer(result_text, reply_markup=admin_kb.admin_kb.as_markup())
-    await callback.message.delete()
-    await callback.answer('')
 
 @broadcast_router.callback_query(F.data=='send_video')
 async def get_video(callback: CallbackQuery, state: FSMContext):
@@ -207,32 +259,20 @@ async def receive_caption(message: Message, state: FSMContext):
 
 
 @broadcast_router.callback_query(F.data=='confirm_send_video', SendVideo.waiting_for_confirm)
-async def broadcast_video_confirm(callback: CallbackQuery, bot: Bot, session: AsyncSession, state: FSMContext):
+async def broadcast_video_confirm(callback: CallbackQuery, session: AsyncSession, state: FSMContext, broadcast_manager: BroadcastManager):
     data = await state.get_data()
     video = data.get('video')
     caption = data.get('caption')
     await state.clear()
-    success_count, failed_count = await send_broadcast(
-        bot=bot,
-        session=session,
-        send_func=bot.send_video,
+    await launch_broadcast(
+        callback, session, broadcast_manager,
+        method='send_video',
         content_type="видео",
         video=video,
-        caption=caption
+        caption=caption,
+        segment=data.get('segment'),
+        segment_funnel_id=data.get('segment_funnel_id')
     )
-    # Формируем результат с дополнительной информацией о видео
-    if success_count > 0 or failed_count > 0:
-        result_text = (
-            f"✅ Рассылка видео завершена!\n\n"
-            f"📤 Отправлено: {success_count}\n"
-            f"❌ Ошибок: {failed_count}\n\n"
-            f"📝 Видео: <i>\"{video}\"</i>\n"
-            f"📝 Подпись: {caption if caption else 'Без подписи'}"
-        )
-    else:
-        result_text = "Список пользователей пуст"
-    await callback.message.answer(result_text, reply_markup=admin_kb.admin_kb.as_markup())
-    await callback.answer('')
 
 @broadcast_router.callback_query(F.data=='send_video_note')
 async def send_video_node(callback: CallbackQuery, state: FSMContext):
@@ -252,19 +292,243 @@ async def receive_video_note(message: Message, state: FSMContext):
         reply_markup=admin_kb.confirm_send_video_note)
 
 @broadcast_router.callback_query(F.data=='confirm_send_video_note', SendVideoNote.waiting_for_confirm)
-async def broadcast_video_note_confirm(callback: CallbackQuery, bot: Bot, session: AsyncSession, state: FSMContext):
+async def broadcast_video_note_confirm(callback: CallbackQuery, session: AsyncSession, state: FSMContext, broadcast_manager: BroadcastManager):
     data = await state.get_data()
     video_note = data.get('video_note')
     await state.clear()
-    success_count, failed_count = await send_broadcast(
-        bot=bot,
-        session=session,
-        send_func=bot.send_video_note,
+    await launch_broadcast(
+        callback, session, broadcast_manager,
+        method='send_video_note',
         content_type="кружок",
-        video_note=video_note
+        video_note=video_note,
+        segment=data.get('segment'),
+        segment_funnel_id=data.get('segment_funnel_id')
+    )
+
+@broadcast_router.callback_query(F.data.startswith('broadcast_cancel:'))
+async def cancel_running_broadcast(callback: CallbackQuery, broadcast_manager: BroadcastManager):
+    job_id = int(callback.data.split(':')[1])
+    if broadcast_manager.cancel(job_id):
+        await callback.answer('Останавливаю рассылку...')
+    else:
+        await callback.answer('Рассылка уже завершена')
+
+delivery_status_text = {
+    'sent': '📤 Доставлено',
+    'blocked': '🚫 Недоступны',
+    'failed': '❌ Ошибки'
+}
+
+@broadcast_router.callback_query(F.data=='broadcast_jobs')
+async def show_broadcast_jobs(callback: CallbackQuery, session: AsyncSession):
+    await callback.message.delete()
+    await callback.answer('')
+    jobs = await get_recent_broadcast_jobs(session)
+    if not jobs:
+        await callback.message.answer('Рассылок пока не было', reply_markup=admin_kb.broadcast_menu.as_markup())
+        return
+    await callback.message.answer('📊 Выберите рассылку:', reply_markup=admin_kb.get_broadcast_jobs_kb(jobs))
+
+@broadcast_router.callback_query(F.data.startswith('broadcast_stats:'))
+async def show_broadcast_job_stats(callback: CallbackQuery, session: AsyncSession):
+    await callback.message.delete()
+    await callback.answer('')
+    job_id = int(callback.data.split(':')[1])
+    job = await session.get(BroadcastJob, job_id)
+    if not job:
+        await callback.message.answer('❌ Рассылка не найдена', reply_markup=admin_kb.broadcast_menu.as_markup())
+        return
+
+    breakdown = await get_broadcast_error_breakdown(session, job_id)
+    percentiles = await get_broadcast_latency_percentiles(session, job_id)
+
+    text = f'📊 <b>Рассылка #{job.id}</b> ({job.content_type})\n'
+    text += f'📅 <b>Создана:</b> {job.created_at.strftime("%d.%m.%Y %H:%M")}\n'
+    text += f'🔄 <b>Статус:</b> {job.status}\n'
+    text += f'🎯 <b>Аудитория:</b> {admin_kb.BROADCAST_SEGMENTS.get(job.segment or "all", job.segment)}\n\n'
+
+    status_totals = {}
+    for status, _, count in breakdown:
+        status_totals[status] = status_totals.get(status, 0) + count
+    for status, count in status_totals.items():
+        text += f'{delivery_status_text.get(status, status)}: {count}\n'
+
+    errors = [(error_code, count) for status, error_code, count in breakdown if status != 'sent']
+    if errors:
+        text += '\n<b>Ошибки:</b>\n'
+        for error_code, count in errors[:10]:
+            text += f'• {error_code}: {count}\n'
+
+    if percentiles:
+        text += '\n<b>Задержка отправки:</b>\n'
+        text += ' / '.join(f'p{p}: {ms} мс' for p, ms in percentiles.items()) + '\n'
+
+    await callback.message.answer(text, reply_markup=admin_kb.back_to_admin.as_markup())
+
+@broadcast_router.callback_query(
+    F.data=='schedule_broadcast',
+    StateFilter(*CONFIRM_STATES)
+)
+async def start_schedule_broadcast(callback: CallbackQuery, state: FSMContext):
+    await callback.message.delete()
+    await callback.answer('')
+    data = await state.get_data()
+    method, content_type, payload = get_confirmed_broadcast(await state.get_state(), data)
+    await state.set_data({
+        'method': method,
+        'content_type': content_type,
+        'payload': payload,
+        'segment': data.get('segment'),
+        'segment_funnel_id': data.get('segment_funnel_id')
+    })
+    await state.set_state(ScheduleBroadcast.waiting_for_time)
+    await callback.message.answer(
+        '🕐 Введите дату и время рассылки:\n\n'
+        '<i>Формат: ДД.ММ ЧЧ:ММ (например: 15.01 18:30)</i>\n\n'
+        'Для отмены введите /cancel',
+        reply_markup=ForceReply(selective=True, input_field_placeholder="ДД.ММ ЧЧ:ММ")
     )
-    result_text = format_broadcast_result(success_count, failed_count, "кружок", video_note)
-    await callback.message.answer(result_text, reply_markup=admin_kb.admin_kb.as_markup())
+
+def parse_schedule_time(text: str, now: datetime) -> datetime | None:
+    """
+    Ближайшее будущее время для ввода "ДД.ММ ЧЧ:ММ" или None, если формат неверный
+
+    Год не вводится: прошедшая в этом году дата переносится на следующий год,
+    29.02 - на ближайший високосный.
+    """
+    try:
+        # Високосный год, чтобы 29.02 прошло проверку формата
+        parsed = datetime.strptime(f"{text} 2000", '%d.%m %H:%M %Y')
+    except ValueError:
+        return None
+    for year in range(now.year, now.year + 5):
+        try:
+            scheduled_at = parsed.replace(year=year)
+        except ValueError:
+            continue
+        if scheduled_at > now:
+            return scheduled_at
+    return None
+
+@broadcast_router.message(F.text, ScheduleBroadcast.waiting_for_time)
+async def get_schedule_time(message: Message, state: FSMContext, session: AsyncSession, broadcast_scheduler: BroadcastScheduler):
+    scheduled_at = parse_schedule_time(message.text.strip(), datetime.now())
+    if scheduled_at is None:
+        await message.answer(
+            '❌ Неверный формат. Попробуйте снова:\n\n<i>Формат: ДД.ММ ЧЧ:ММ (например: 15.01 18:30)</i>',
+            reply_markup=ForceReply(selective=True, input_field_placeholder="ДД.ММ ЧЧ:ММ")
+        )
+        return
+
+    data = await state.get_data()
+    await state.clear()
+    job = await create_broadcast_job(
+        session,
+        data['method'],
+        data['content_type'],
+        data['payload'],
+        admin_chat_id=message.chat.id,
+        scheduled_at=scheduled_at,
+        segment=data.get('segment'),
+        segment_funnel_id=data.get('segment_funnel_id')
+    )
+    broadcast_scheduler.add(job.id, scheduled_at)
+    await message.answer(
+        f'✅ Рассылка #{job.id} ({job.content_type}) запланирована на '
+        f'<b>{scheduled_at.strftime("%d.%m.%Y %H:%M")}</b>',
+        reply_markup=admin_kb.broadcast_menu.as_markup()
+    )
+
+async def send_scheduled_broadcasts(message: Message, session: AsyncSession):
+    """Отправляет список запланированных рассылок с кнопками отмены"""
+    jobs = await get_scheduled_broadcast_jobs(session)
+    if not jobs:
+        await message.answer('Запланированных рассылок нет', reply_markup=admin_kb.broadcast_menu.as_markup())
+        return
+    text = '🕐 <b>Запланированные рассылки</b>\n\n'
+    for job in jobs:
+        text += f'<b>#{job.id}</b> {job.scheduled_at.strftime("%d.%m.%Y %H:%M")} — {job.content_type}\n'
+        text += f'<i>{describe_broadcast_job(job)[:100]}</i>\n\n'
+    await message.answer(text, reply_markup=admin_kb.get_scheduled_broadcasts_kb(jobs))
+
+@broadcast_router.callback_query(F.data=='scheduled_broadcasts')
+async def show_scheduled_broadcasts(callback: CallbackQuery, session: AsyncSession):
     await callback.message.delete()
     await callback.answer('')
+    await send_scheduled_broadcasts(callback.message, session)
+
+@broadcast_router.callback_query(F.data.startswith('cancel_scheduled:'))
+async def cancel_scheduled_broadcast(callback: CallbackQuery, session: AsyncSession, broadcast_scheduler: BroadcastScheduler):
+    job_id = int(callback.data.split(':')[1])
+    if await change_broadcast_job_status(session, job_id, 'cancelled', expected_status='scheduled'):
+        broadcast_scheduler.discard(job_id)
+        await callback.answer(f'Рассылка #{job_id} отменена')
+    else:
+        await callback.answer('Рассылка уже запущена или отменена')
+    await callback.message.delete()
+    await send_scheduled_broadcasts(callback.message, session)
 
+def get_confirm_kb(state_name: str) -> InlineKeyboardMarkup:
+    """Клавиатура подтверждения для текущего состояния рассылки"""
+    return {
+        BroadcastSettings.waiting_for_custom_confirm.state: admin_kb.confirm_send_custom_text,
+        BroadcastSettings.waiting_for_default_text_confirm.state: admin_kb.confirm_send_default_text,
+        SendVideo.waiting_for_confirm.state: admin_kb.confirm_send_video,
+        SendVideoNote.waiting_for_confirm.state: admin_kb.confirm_send_video_note,
+    }[state_name]
+
+async def send_audience_preview(message: Message, session: AsyncSession, state: FSMContext):
+    """Показывает выбранную аудиторию и число получателей (один COUNT по сегменту)"""
+    data = await state.get_data()
+    segment = data.get('segment') or 'all'
+    count = await count_active_users(session, condition=get_segment_condition(segment, data.get('segment_funnel_id')))
+    title = admin_kb.BROADCAST_SEGMENTS[segment]
+    if data.get('segment_funnel_name'):
+        title += f' «{data["segment_funnel_name"]}»'
+    await message.answer(
+        f'🎯 <b>Аудитория:</b> {title}\n'
+        f'👥 <b>Получателей:</b> {count}\n\n'
+        f'Подтвердите рассылку:',
+        reply_markup=get_confirm_kb(await state.get_state())
+    )
+
+@broadcast_router.callback_query(F.data=='choose_segment', StateFilter(*CONFIRM_STATES))
+async def choose_broadcast_segment(callback: CallbackQuery):
+    await callback.message.delete()
+    await callback.answer('')
+    await callback.message.answer('🎯 Выберите аудиторию рассылки:', reply_markup=admin_kb.get_broadcast_segments_kb())
+
+@broadcast_router.callback_query(F.data=='segment_back', StateFilter(*CONFIRM_STATES))
+async def back_to_audience_preview(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
+    await callback.message.delete()
+    await callback.answer('')
+    await send_audience_preview(callback.message, session, state)
+
+@broadcast_router.callback_query(F.data.startswith('segment:'), StateFilter(*CONFIRM_STATES))
+async def select_broadcast_segment(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
+    segment = callback.data.split(':')[1]
+    if segment in FUNNEL_SEGMENTS:
+        funnels = await get_all_funnels(session)
+        if not funnels:
+            await callback.answer('Воронок пока нет', show_alert=True)
+            return
+        await callback.message.delete()
+        await callback.answer('')
+        await callback.message.answer('📋 Выберите воронку:', reply_markup=admin_kb.get_segment_funnels_kb(funnels, segment))
+        return
+    await callback.message.delete()
+    await callback.answer('')
+    await state.update_data(segment=segment, segment_funnel_id=None, segment_funnel_name=None)
+    await send_audience_preview(callback.message, session, state)
+
+@broadcast_router.callback_query(F.data.startswith('segment_funnel:'), StateFilter(*CONFIRM_STATES))
+async def select_segment_funnel(callback: CallbackQuery, session: AsyncSession, state: FSMContext):
+    _, segment, funnel_id = callback.data.split(':')
+    funnel = await session.get(Funnel, int(funnel_id))
+    if funnel is None:
+        await callback.answer('Воронка не найдена', show_alert=True)
+        return
+    await callback.message.delete()
+    await callback.answer('')
+    await state.update_data(segment=segment, segment_funnel_id=funnel.id, segment_funnel_name=funnel.name)
+    await send_audience_preview(callback.message, session, state)
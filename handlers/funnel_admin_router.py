@@ -1,16 +1,16 @@
+import html
 import logging
+from datetime import date, timedelta
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove, ForceReply
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import func, select
-from sqlalchemy.orm import selectinload
 
 import keyboards.funnel_kb as funnel_kb
 import filters.admin_filter as Admin
-from database.models import Funnel, FunnelStep, FunnelProgress
+from database.models import Funnel, FunnelStep
 from database.orm_query import (
     get_active_funnels, 
     get_funnel_with_steps, 
@@ -18,8 +18,13 @@ from database.orm_query import (
     create_funnel_step, 
     delete_funnel,
     deactivate_or_activate_funnel,
-    get_all_funnels
+    get_all_funnels,
+    get_funnel_stats,
+    get_funnel_participants,
+    get_completed_funnel_users_page,
+    FUNNEL_STAT_COUNTERS
 )
+from config import ADMIN_FUNNEL_USERS_PAGE_SIZE
 
 content_type_text = {
             'video': 'Видео',
@@ -398,42 +403,80 @@ async def show_funnel_stats(callback: CallbackQuery, session: AsyncSession):
 
 async def show_funnel_stats_for_funnel(message: Message, session: AsyncSession, funnel: Funnel):
     """Показывает статистику конкретной воронки"""
-    # Получаем статистику
-    # Общее количество участников
-    total_users = await session.scalar(
-        select(func.count(FunnelProgress.id))
-        .where(FunnelProgress.funnel_id == funnel.id)
-    )
-    
-    # Завершивших курс
-    completed_users = await session.scalars(
-        select(FunnelProgress)
-        .options(selectinload(FunnelProgress.user))
-        .where(FunnelProgress.funnel_id == funnel.id)
-        .where(FunnelProgress.is_completed == True)
-    )
-    completed_users = completed_users.all()
-    # Активных участников (не завершивших)
-    active_users = total_users - len(completed_users) if total_users else 0
+    # Участники - по строке прогресса на пользователя, перезапуски курса их не умножают
+    participants, completed_users = await get_funnel_participants(session, funnel.id)
+    # Счетчики из funnel_stats: по строке на этап, независимо от числа участников
+    stats = await get_funnel_stats(session, funnel.id)
+    week_stats = await get_funnel_stats(session, funnel.id, since=date.today() - timedelta(days=6))
+    funnel_with_steps = await get_funnel_with_steps(session, funnel.id)
+    steps = funnel_with_steps.steps if funnel_with_steps else []
+    empty = dict.fromkeys(FUNNEL_STAT_COUNTERS, 0)
+    total, week = stats.get(0, empty), week_stats.get(0, empty)
     
-    # Конверсия
-    conversion = (len(completed_users) / total_users * 100) if total_users > 0 else 0
+    # Конверсия участников: завершившие курс от всех, кто его начинал
+    conversion = (completed_users / participants * 100) if participants > 0 else 0
     
     stats_text = f'📊 <b>Статистика воронки "{funnel.name}"</b>\n\n'
-    stats_text += f'👥 <b>Всего участников:</b> {total_users}\n'
-    stats_text += f'✅ <b>Завершили курс:</b> {len(completed_users)}\n'
-    stats_text += f'🔄 <b>В процессе:</b> {active_users}\n'
-    stats_text += f'📈 <b>Конверсия:</b> {conversion:.1f}%\n'
-    
-    if completed_users:
-        stats_text += "👤 Список завершивших:\n"
-        for idx, progress in enumerate(completed_users, start=1):
-            user = progress.user
-            phone = user.phone if user.phone else "📵 Нет номера"
-            stats_text += f"{idx}. {user.name} — {phone}\n"
+    stats_text += f'👥 <b>Всего участников:</b> {participants}\n'
+    stats_text += f'✅ <b>Завершили курс:</b> {completed_users}\n'
+    stats_text += f'🔄 <b>В процессе:</b> {participants - completed_users}\n'
+    stats_text += f'📈 <b>Конверсия:</b> {conversion:.1f}%\n\n'
+    stats_text += f'🚀 <b>Стартов курса</b> (с перезапусками): {total["started"]} (за 7 дней: {week["started"]})\n'
+    stats_text += f'🏁 <b>Завершений курса:</b> {total["completed"]} (за 7 дней: {week["completed"]})\n'
+
+    first_reached = stats.get(1, empty)['reached']
+    if first_reached and steps:
+        stats_text += '\n📉 <b>Переходы по этапам</b> (всего / за 7 дней):\n'
+        for position, step in enumerate(steps, start=1):
+            step_stats, step_week = stats.get(position, empty), week_stats.get(position, empty)
+            percent = min(step_stats['reached'] / first_reached * 100, 100)
+            stats_text += f'{position}. {html.escape(step.title)}\n'
+            stats_text += (
+                f'{"█" * round(percent / 10)}{"░" * (10 - round(percent / 10))} '
+                f'{step_stats["reached"]} ({percent:.0f}%) / {step_week["reached"]}\n'
+            )
+            if not step.is_free:
+                stats_text += f'💰 Остановились на платном этапе: {step_stats["paid_gate_hits"]} / {step_week["paid_gate_hits"]}\n'
+
+    await message.answer(stats_text, reply_markup=funnel_kb.get_funnel_stats_kb(funnel.id))
+
+
+# Список завершивших воронку постранично
+@funnel_admin_router.callback_query(F.data.startswith('funnel_completed:'))
+async def show_funnel_completed_users(callback: CallbackQuery, session: AsyncSession):
+    await callback.answer('')
+    # funnel_completed:<id воронки>:<n - вперед, p - назад>:<id прогресса границы страницы, 0 - с начала>
+    _, funnel_id, direction, cursor = callback.data.split(':')
+    funnel_id, cursor = int(funnel_id), int(cursor) or None
+    funnel = await session.get(Funnel, funnel_id)
+    if not funnel:
+        await callback.message.answer('❌ Воронка не найдена.')
+        return
 
+    if direction == 'p':
+        rows, has_prev = await get_completed_funnel_users_page(session, funnel_id, ADMIN_FUNNEL_USERS_PAGE_SIZE, before_id=cursor)
+        has_next = True
+    else:
+        rows, has_next = await get_completed_funnel_users_page(session, funnel_id, ADMIN_FUNNEL_USERS_PAGE_SIZE, after_id=cursor)
+        has_prev = cursor is not None
 
-    await message.answer(stats_text, reply_markup=funnel_kb.admin_funnel_kb.as_markup())
+    text = f'👤 <b>Завершившие воронку "{funnel.name}"</b>\n\n'
+    if rows:
+        for _, name, phone in rows:
+            text += f"• {html.escape(name or '')} — {phone if phone else '📵 Нет номера'}\n"
+    else:
+        text += 'Пока никто не завершил воронку.'
+    reply_markup = funnel_kb.get_funnel_completed_kb(
+        funnel_id,
+        rows[0][0] if rows else None,
+        rows[-1][0] if rows else None,
+        has_prev and bool(rows),
+        has_next and bool(rows)
+    )
+    if cursor is None:
+        await callback.message.answer(text, reply_markup=reply_markup)
+    else:
+        await callback.message.edit_text(text, reply_markup=reply_markup)
 
 # Настройки воронки
 # @funnel_admin_router.callback_query(F.data == 'funnel_settings')
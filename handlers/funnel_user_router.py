@@ -16,14 +16,16 @@ from database.orm_query import (
     get_active_funnels, 
     start_user_funnel, 
     get_user_funnel_progress, 
-    get_funnel_with_steps, 
     advance_user_funnel,
+    complete_user_funnel,
+    uncomplete_user_funnel,
     reset_user_funnel_progress,
     get_user_all_funnel_progress,
     check_user_phone,
     update_phone
 )
 from database.models import FunnelProgress, Funnel
+from database.funnel_cache import funnel_cache, FunnelSnapshot
 import phonenumbers
 from filters.admin_filter import admin 
 
@@ -88,10 +90,10 @@ async def send_admin_notification(bot, user_id: int, username: str, notification
         logging.exception("Ошибка отправки уведомления админу")
 
 # Функция для отправки этапа воронки
-async def send_funnel_step(message: Message, session: AsyncSession, progress: FunnelProgress, funnel: Funnel, user: User = None):
+async def send_funnel_step(message: Message, session: AsyncSession, progress: FunnelProgress, funnel: Funnel | FunnelSnapshot, user: User = None):
     """Отправляет этап воронки пользователю"""
     try:
-        funnel_with_steps = await get_funnel_with_steps(session, funnel.id)
+        funnel_with_steps = await funnel_cache.get(session, funnel.id)
         
         # Проверяем, есть ли этапы в воронке
         if not funnel_with_steps or not funnel_with_steps.steps:
@@ -101,34 +103,27 @@ async def send_funnel_step(message: Message, session: AsyncSession, progress: Fu
             )
             return
         
-        total_steps = len(funnel_with_steps.steps)
+        total_steps = funnel_with_steps.total_steps
 
         # НОВАЯ ПРОВЕРКА: Если курс помечен как завершенный, но этапов стало больше
         try:
-            if progress.is_completed and progress.current_step < total_steps:
-                # Проверяем, есть ли бесплатные этапы после текущего
-                has_free_steps_ahead = False
-                for i in range(progress.current_step - 1, total_steps):  # -1 потому что индексация с 0
-                    step = funnel_with_steps.steps[i]
-                    if step.is_free:
-                        has_free_steps_ahead = True
-                        break
-                
-                # Если есть бесплатные этапы впереди, снимаем флаг завершения
-                if has_free_steps_ahead:
-                    progress.is_completed = False
-                    progress.completed_at = None
-                    await session.commit()
+            # Если есть бесплатные этапы впереди, снимаем флаг завершения.
+            # На платном этапе курс остается завершенным: дальше пользователь не пройдет
+            if (
+                progress.is_completed
+                and progress.current_step < total_steps
+                and not funnel_with_steps.is_paid_gate(progress.current_step)
+                and funnel_with_steps.has_free_step_from(progress.current_step)
+            ):
+                await uncomplete_user_funnel(session, progress)
         except Exception as e:
             logging.exception("Ошибка обновления прогресса")
         # Проверяем, что текущий этап существует
-        if progress.current_step > len(funnel_with_steps.steps) or progress.current_step < 1:
+        current_step = funnel_with_steps.step(progress.current_step)
+        if current_step is None:
             await message.answer('❌ Этап не найден')
             return
         
-        current_step = funnel_with_steps.steps[progress.current_step - 1]
-        
-        
         # Формируем текст сообщения
         step_text = f'📚 <b>{current_step.title}</b>\n\n'
 
@@ -140,9 +135,7 @@ async def send_funnel_step(message: Message, session: AsyncSession, progress: Fu
             # Бесплатный этап
             if progress.current_step == total_steps:
                 # Это последний этап - курс завершен
-                progress.is_completed = True
-                progress.completed_at = datetime.now()
-                await session.commit()
+                await complete_user_funnel(session, progress)
                 await send_admin_notification(bot=message.bot, user_id=user.id, username=user.username, notification_type="course_completed", session=session, course_name=funnel.name, total_steps=total_steps)
                 logging.info("Пользователь: %d завершил курс (funnel id: %d)", user.id, funnel.id)
                 step_text += '🎉 <b>Поздравляем! Вы завершили курс!</b>\n\n'
@@ -153,9 +146,7 @@ async def send_funnel_step(message: Message, session: AsyncSession, progress: Fu
                 reply_markup = funnel_kb.funnel_next_kb
         else:
             # Платный этап - курс завершен на платной части
-            progress.is_completed = True
-            progress.completed_at = datetime.now()
-            await session.commit()
+            await complete_user_funnel(session, progress, paid_gate=progress.current_step)
             await send_admin_notification(bot=message.bot, user_id=user.id, username=user.username, notification_type="paid_step_reached", session=session, course_name=funnel.name, total_steps=total_steps)
             logging.info("Пользователь: %d дошел до платного этапа курса (funnel id: %d)", user.id, funnel.id)
             step_text += '💰 <b>Это платный этап курса</b>\n\n'
@@ -225,7 +216,7 @@ async def show_course_selection(message: Message, funnels: list[Funnel]):
     
     await message.answer(text, reply_markup=kb)
 
-async def start_course_for_user(message: Message, session: AsyncSession, funnel: Funnel, state: FSMContext = None, user: User = None):
+async def start_course_for_user(message: Message, session: AsyncSession, funnel: Funnel | FunnelSnapshot, state: FSMContext = None, user: User = None):
     """Начинает курс для пользователя"""
     # Получаем или создаем прогресс пользователя
     progress = await start_user_funnel(session, message.chat.id, funnel.id)
@@ -300,7 +291,7 @@ async def select_course_handler(callback: CallbackQuery, session: AsyncSession,
     try:
         # Извлекаем ID курса из callback_data
         funnel_id = int(callback.data.split(':')[1])
-        funnel = await session.get(Funnel, funnel_id)
+        funnel = await funnel_cache.get(session, funnel_id)
         
         if funnel and funnel.is_active:
             await start_course_for_user(callback.message, session, funnel, state, callback.from_user)
@@ -324,8 +315,8 @@ async def next_funnel_step(callback: CallbackQuery, session: AsyncSession, state
             await callback.message.answer('❌ Курс не найден. Начните курс заново.')
             return
         
-        # Получаем текущую воронку
-        current_funnel = await session.get(Funnel, current_funnel_id)
+        # Получаем текущую воронку из кэша
+        current_funnel = await funnel_cache.get(session, current_funnel_id)
         if not current_funnel:
             await callback.message.answer('❌ Курс не найден. Начните курс заново.')
             return
@@ -347,7 +338,9 @@ async def next_funnel_step(callback: CallbackQuery, session: AsyncSession, state
         #     return
         
         # Переходим к следующему этапу
-        updated_progress = await advance_user_funnel(session, callback.from_user.id, current_funnel_id)
+        # Переход сравнивает версию прогресса, прочитанного выше в этом же обработчике,
+        # с версией в момент UPDATE: параллельное нажатие между ними не даст перейти дважды
+        updated_progress = await advance_user_funnel(session, callback.from_user.id, current_funnel_id, user_progress)
         
         if updated_progress:
             # Отправляем следующий этап (логика завершения обрабатывается в send_funnel_step)
@@ -372,8 +365,8 @@ async def show_funnel_progress(callback: CallbackQuery, session: AsyncSession, s
         logging.warning("Курс не найден. нету данных из state: current_funnel_id is None")
         return
     
-    # Получаем текущую воронку
-    current_funnel = await session.get(Funnel, current_funnel_id)
+    # Получаем текущую воронку из кэша
+    current_funnel = await funnel_cache.get(session, current_funnel_id)
     if not current_funnel:
         logging.error(f"Нету воронки с id переданным из state: {current_funnel_id}")
         await callback.message.answer('❌ Курс не найден. Начните курс заново.')
@@ -389,27 +382,24 @@ async def show_funnel_progress(callback: CallbackQuery, session: AsyncSession, s
     
     # Показываем прогресс
     try:
-        funnel_with_steps = await get_funnel_with_steps(session, current_funnel_id)
-        total_steps = len(funnel_with_steps.steps) if funnel_with_steps else 0
+        total_steps = len(current_funnel.steps)
         
         progress_text = f'📊 <b>Ваш прогресс в курсе "{current_funnel.name}"</b>\n\n'
         progress_text += f'📈 <b>Этап:</b> {user_progress.current_step} из {total_steps}\n'
         progress_text += f'📅 <b>Начато:</b> {user_progress.started_at.strftime("%d.%m.%Y")}\n'
         
-        if user_progress.is_completed and user_progress.current_step == total_steps:
+        if user_progress.is_completed and current_funnel.is_final(user_progress.current_step):
             progress_text += f'✅ <b>Статус:</b> Завершено\n'
             progress_text += f'🎯 <b>Завершено:</b> {user_progress.completed_at.strftime("%d.%m.%Y")}\n'
         else:
             progress_text += f'🔄 <b>Статус:</b> В процессе\n'
             # Сбрасываем флаг только если он был установлен неправильно
             if user_progress.is_completed:
-                user_progress.is_completed = False
-                user_progress.completed_at = None
-                await session.commit()
+                await uncomplete_user_funnel(session, user_progress)
             
             # Показываем информацию о следующем этапе
-            if user_progress.current_step <= total_steps and funnel_with_steps:
-                current_step = funnel_with_steps.steps[user_progress.current_step - 1]
+            current_step = current_funnel.step(user_progress.current_step)
+            if current_step is not None:
                 progress_text += f'📚 <b>Следующий урок:</b> {current_step.title}\n'
                 progress_text += f'💰 <b>Тип:</b> {"Бесплатный" if current_step.is_free else "Платный"}\n'
         
@@ -457,7 +447,7 @@ async def restart_course_handler(callback: CallbackQuery, session: AsyncSession,
     
     if current_funnel_id:
         # Перезапускаем текущий курс
-        current_funnel = await session.get(Funnel, current_funnel_id)
+        current_funnel = await funnel_cache.get(session, current_funnel_id)
         if current_funnel and current_funnel.is_active:
             # Сбрасываем прогресс пользователя
             await reset_user_funnel_progress(session, callback.from_user.id, current_funnel_id)
@@ -492,15 +482,14 @@ async def show_my_courses(callback: CallbackQuery, session: AsyncSession, state:
     
     try:
         for progress in user_progresses:
-            funnel = await session.get(Funnel, progress.funnel_id)
+            funnel = await funnel_cache.get(session, progress.funnel_id)
             if funnel and funnel.is_active:
-                funnel_with_steps = await get_funnel_with_steps(session, funnel.id)
-                total_steps = len(funnel_with_steps.steps) if funnel_with_steps else 0
+                total_steps = len(funnel.steps)
                 
                 text += f'📋 <b>{funnel.name}</b>\n'
                 text += f'📈 Прогресс: {progress.current_step} из {total_steps}\n'
                 
-                if progress.is_completed and progress.current_step == total_steps:
+                if progress.is_completed and funnel.is_final(progress.current_step):
                     text += f'✅ Статус: Завершен\n'
                     text += f'🎯 Завершен: {progress.completed_at.strftime("%d.%m.%Y")}\n'
                 else:
@@ -508,9 +497,7 @@ async def show_my_courses(callback: CallbackQuery, session: AsyncSession, state:
                     text += f'📅 Начат: {progress.started_at.strftime("%d.%m.%Y")}\n'
                     # Сбрасываем флаг только если он был установлен неправильно
                     if progress.is_completed:
-                        progress.is_completed = False
-                        progress.completed_at = None
-                        await session.commit()
+                        await uncomplete_user_funnel(session, progress)
                 
                 text += '\n'
     except Exception:
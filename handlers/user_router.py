@@ -2,11 +2,12 @@ import phonenumbers
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import exc, select, delete
 from database.models import User, Service
-from database.orm_query import get_or_create_user, deactivate_user, create_booking, get_user_bookings, update_phone, check_user_phone
+from database.orm_query import get_or_create_user, deactivate_user, create_booking, count_user_bookings, update_phone, check_user_phone
+from config import MAX_BOOKINGS_PER_USER
 
 from keyboards.user_menu import set_user_menu
 from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery, FSInputFile, ChatMemberUpdated, \
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, \
     InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, Contact, ReplyKeyboardRemove, ResultChatMemberUnion, ForceReply
 from aiogram.filters import CommandStart, Command, or_f, StateFilter
 import keyboards.user_kb as user_kb
@@ -16,12 +17,16 @@ from aiogram.fsm.state import State, StatesGroup
 from filters.admin_filter import admin
 from datetime import datetime
 from filters.month_filter import month_filter
+from utils.media_registry import media_registry
 import os
 import logging
 
 # logger = logging.getLogger(__name__)
 
 
+QUOTA_EXCEEDED_TEXT = f"Вы не можете сделать больше {MAX_BOOKINGS_PER_USER} записей\nПожалуйста подождите я c вами свяжусь"
+
+
 class Signup(StatesGroup):
     waiting_for_name = State()
     waiting_for_phone = State()
@@ -33,7 +38,14 @@ CHANNEL_ID = -1002726677960
 user_router = Router()
 user_router.startup.register(set_user_menu)
 image_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "start.webp")
-image = FSInputFile(image_path, filename='olesya.webp')
+
+
+async def send_start_image(bot: Bot, session: AsyncSession, chat_id: int):
+    """Стартовое сообщение с картинкой, картинка загружается в Telegram один раз"""
+    await media_registry.send(
+        bot, session, chat_id, image_path, 'photo', filename='olesya.webp',
+        caption=START_TEXT, reply_markup=user_kb.start_kb.as_markup()
+    )
 
 
 @user_router.message(CommandStart())
@@ -41,7 +53,7 @@ async def start(message: Message, session: AsyncSession):
     try:
         from_user = message.from_user
         user = await get_or_create_user(session, from_user.id, from_user.full_name)
-        await message.answer_photo(photo=image, caption=START_TEXT, reply_markup=user_kb.start_kb.as_markup())
+        await send_start_image(message.bot, session, message.chat.id)
     except Exception as e:
         logging.exception("Ошибка при добавлении/получении пользователя:")
 
@@ -80,11 +92,10 @@ async def service_list(callback: CallbackQuery, session: AsyncSession):
     await callback.answer('Мои услуги')
 
 @user_router.callback_query(F.data=='back')
-async def back(callback: CallbackQuery):
+async def back(callback: CallbackQuery, session: AsyncSession):
     await callback.message.delete()
     await callback.answer('')
-    await callback.message.answer_photo(photo=image, caption=START_TEXT, 
-    reply_markup=user_kb.start_kb.as_markup())
+    await send_start_image(callback.bot, session, callback.message.chat.id)
 
 
 
@@ -138,11 +149,11 @@ async def cancel_signup(message: Message, state: FSMContext):
 
 @user_router.callback_query(F.data.startswith('signup_'))
 async def start_signup(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
-    book_user = await get_user_bookings(session, user_id=callback.from_user.id)
-    if book_user >= 3:
-        logging.info(f'У user: {callback.from_user.id} пытается сделать больше 3 записей')
-        await callback.message.answer("Вы не можете сделать больше трёх записей\nПожалуйста подождите я c вами свяжусь")
-        await callback.answer('Более 3 записей недопустимо')
+    book_user = await count_user_bookings(session, user_id=callback.from_user.id)
+    if book_user >= MAX_BOOKINGS_PER_USER:
+        logging.info(f'У user: {callback.from_user.id} пытается сделать больше {MAX_BOOKINGS_PER_USER} записей')
+        await callback.message.answer(QUOTA_EXCEEDED_TEXT)
+        await callback.answer(f'Более {MAX_BOOKINGS_PER_USER} записей недопустимо')
         return
     service_id = int(callback.data.split('_')[1])
     service = await session.scalar(select(Service).where(Service.id == service_id))
@@ -308,6 +319,11 @@ async def get_time(message: Message, state: FSMContext, bot: Bot, session: Async
             preferred_date=data['preferred_date'],
             preferred_time=data['preferred_time']
         )   
+        if booking is None:
+            # Лимит исчерпан, пока пользователь заполнял запись (например, параллельная запись)
+            await message.answer(QUOTA_EXCEEDED_TEXT, reply_markup=user_kb.back_mrk)
+            await state.clear()
+            return
         # Уведомляем админа
         admin_text = f"🎯 <b>Новая запись на услугу!</b>\n\n"
         admin_text += f"👤 <b>Клиент:</b> {data['name']}\n"
@@ -14,6 +14,8 @@ broadcast_menu = InlineKeyboardBuilder()
 broadcast_menu.button(text='📝 Рассылка текста', callback_data='send_all')
 broadcast_menu.button(text='📹 Рассылка видео', callback_data='send_video')
 broadcast_menu.button(text='🟡 Рассылка кружка', callback_data='send_video_note')
+broadcast_menu.button(text='🕐 Запланированные рассылки', callback_data='scheduled_broadcasts')
+broadcast_menu.button(text='📊 Статистика рассылок', callback_data='broadcast_jobs')
 broadcast_menu.button(text='🔙 Назад', callback_data='back_to_admin')
 broadcast_menu.adjust(1)
 
@@ -39,12 +41,16 @@ confirm_send_video = InlineKeyboardMarkup(
             inline_keyboard=[
                 [InlineKeyboardButton(text='✅ Подтвердить', callback_data='confirm_send_video')],
                 [InlineKeyboardButton(text='✏️ Изменить подпись', callback_data='edit_caption')],
+                [InlineKeyboardButton(text='🎯 Аудитория', callback_data='choose_segment')],
+                [InlineKeyboardButton(text='🕐 Запланировать', callback_data='schedule_broadcast')],
                 [InlineKeyboardButton(text='❌ Отмена', callback_data='broadcast_menu')]
             ]
 )
 confirm_send_video_note = InlineKeyboardMarkup(
             inline_keyboard=[
                 [InlineKeyboardButton(text='✅ Подтвердить', callback_data='confirm_send_video_note')],
+                [InlineKeyboardButton(text='🎯 Аудитория', callback_data='choose_segment')],
+                [InlineKeyboardButton(text='🕐 Запланировать', callback_data='schedule_broadcast')],
                 [InlineKeyboardButton(text='❌ Отмена', callback_data='broadcast_menu')]
             ]
 )
@@ -54,6 +60,8 @@ confirm_send_custom_text = InlineKeyboardMarkup(
     inline_keyboard=[
         [InlineKeyboardButton(text='✅ Подтвердить', callback_data='confirm_send_text')],
         [InlineKeyboardButton(text='✏️ Изменить текст', callback_data='edit_custom_text')],
+        [InlineKeyboardButton(text='🎯 Аудитория', callback_data='choose_segment')],
+        [InlineKeyboardButton(text='🕐 Запланировать', callback_data='schedule_broadcast')],
         [InlineKeyboardButton(text='❌ Отмена', callback_data='broadcast_menu')]
     ]
 )
@@ -62,6 +70,8 @@ confirm_send_default_text = InlineKeyboardMarkup(
     inline_keyboard=[
         [InlineKeyboardButton(text='✅ Подтвердить', callback_data='confirm_send_text')],
         [InlineKeyboardButton(text='✏️ Изменить текст', callback_data='change_default')],
+        [InlineKeyboardButton(text='🎯 Аудитория', callback_data='choose_segment')],
+        [InlineKeyboardButton(text='🕐 Запланировать', callback_data='schedule_broadcast')],
         [InlineKeyboardButton(text='❌ Отмена', callback_data='broadcast_menu')]
     ]
 )
@@ -76,6 +86,133 @@ def get_booking_actions_kb(booking_id: int) -> InlineKeyboardMarkup:
         ])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+def get_broadcast_cancel_kb(job_id: int) -> InlineKeyboardMarkup:
+    """Создает клавиатуру для остановки рассылки"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='⛔ Остановить рассылку', callback_data=f'broadcast_cancel:{job_id}')]
+    ])
+
+def get_broadcast_jobs_kb(jobs) -> InlineKeyboardMarkup:
+    """Создает клавиатуру выбора рассылки для просмотра статистики"""
+    kb = InlineKeyboardBuilder()
+    for job in jobs:
+        kb.button(
+            text=f'#{job.id} {job.content_type} ({job.created_at.strftime("%d.%m %H:%M")})',
+            callback_data=f'broadcast_stats:{job.id}'
+        )
+    kb.button(text='🔙 Назад', callback_data='broadcast_menu')
+    kb.adjust(1)
+    return kb.as_markup()
+
+def get_scheduled_broadcasts_kb(jobs) -> InlineKeyboardMarkup:
+    """Создает клавиатуру отмены запланированных рассылок"""
+    kb = InlineKeyboardBuilder()
+    for job in jobs:
+        kb.button(text=f'❌ Отменить #{job.id}', callback_data=f'cancel_scheduled:{job.id}')
+    kb.button(text='🔙 Назад', callback_data='broadcast_menu')
+    kb.adjust(1)
+    return kb.as_markup()
+
+# Сегменты аудитории рассылки (условия отбора - в orm_query.get_segment_condition)
+BROADCAST_SEGMENTS = {
+    'all': 'Все активные пользователи',
+    'funnel_not_completed': 'Начали воронку, но не завершили',
+    'funnel_paid_step': 'Дошли до платного этапа',
+    'has_booking': 'Есть запись на консультацию',
+    'inactive': 'Неактивные 14+ дней',
+    'has_phone': 'Оставили телефон',
+}
+
+def get_broadcast_segments_kb() -> InlineKeyboardMarkup:
+    """Создает клавиатуру выбора аудитории рассылки"""
+    kb = InlineKeyboardBuilder()
+    for segment, title in BROADCAST_SEGMENTS.items():
+        kb.button(text=title, callback_data=f'segment:{segment}')
+    kb.button(text='🔙 Назад', callback_data='segment_back')
+    kb.adjust(1)
+    return kb.as_markup()
+
+def get_segment_funnels_kb(funnels, segment: str) -> InlineKeyboardMarkup:
+    """Создает клавиатуру выбора воронки для сегмента рассылки"""
+    kb = InlineKeyboardBuilder()
+    for funnel in funnels:
+        kb.button(text=f'📋 {funnel.name}', callback_data=f'segment_funnel:{segment}:{funnel.id}')
+    kb.button(text='🔙 Назад', callback_data='choose_segment')
+    kb.adjust(1)
+    return kb.as_markup()
+
+# Фильтры списка пользователей (условия отбора - в orm_query.get_user_filter_condition)
+USER_FILTERS = {
+    'all': 'Все',
+    'active': 'Активные',
+    'inactive': 'Неактивные',
+    'phone': 'С телефоном',
+}
+
+def get_users_page_kb(user_filter: str, first_tg_id: int | None, last_tg_id: int | None, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    """Создает клавиатуру листания списка пользователей с фильтрами"""
+    buttons = [[
+        InlineKeyboardButton(
+            text=f'✅ {title}' if key == user_filter else title,
+            callback_data=f'users_page:{key}:n:0'
+        )
+        for key, title in USER_FILTERS.items()
+    ]]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'users_page:{user_filter}:p:{first_tg_id}'))
+    if has_next:
+        nav.append(InlineKeyboardButton(text='Вперед ➡️', callback_data=f'users_page:{user_filter}:n:{last_tg_id}'))
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(text='Вернуться в меню', callback_data='back_to_admin')])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+# Периоды фильтра записей (диапазоны дат - в admin_router.get_booking_period_range)
+BOOKING_PERIODS = {
+    'all': 'За все время',
+    'today': 'Сегодня',
+    'week': '7 дней',
+    'month': '30 дней',
+}
+
+def get_bookings_page_kb(
+    service_id: int,
+    period: str,
+    first_cursor: str | None,
+    last_cursor: str | None,
+    has_prev: bool,
+    has_next: bool
+) -> InlineKeyboardMarkup:
+    """Создает клавиатуру листания записей с фильтрами по услуге и периоду (service_id 0 - все услуги)"""
+    buttons = [[
+        InlineKeyboardButton(
+            text=f'✅ {title}' if key == period else title,
+            callback_data=f'bookings_page:{service_id}:{key}:n:0'
+        )
+        for key, title in BOOKING_PERIODS.items()
+    ]]
+    buttons.append([InlineKeyboardButton(text='🎯 Фильтр по услуге', callback_data=f'bookings_services:{period}')])
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text='⬅️ Новее', callback_data=f'bookings_page:{service_id}:{period}:p:{first_cursor}'))
+    if has_next:
+        nav.append(InlineKeyboardButton(text='Старее ➡️', callback_data=f'bookings_page:{service_id}:{period}:n:{last_cursor}'))
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(text='Вернуться в меню', callback_data='back_to_admin')])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def get_bookings_services_kb(services, period: str) -> InlineKeyboardMarkup:
+    """Создает клавиатуру выбора услуги для фильтра записей"""
+    kb = InlineKeyboardBuilder()
+    kb.button(text='Все услуги', callback_data=f'bookings_page:0:{period}:n:0')
+    for service in services:
+        kb.button(text=service.name, callback_data=f'bookings_page:{service.id}:{period}:n:0')
+    kb.button(text='🔙 Назад', callback_data='view_bookings')
+    kb.adjust(1)
+    return kb.as_markup()
+
 review_kb = InlineKeyboardMarkup(
     inline_keyboard=[
         [InlineKeyboardButton(text='Отзывы', url='https://t.me/+znP0wsKNCENlMmVi')]
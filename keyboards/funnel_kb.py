@@ -10,6 +10,30 @@ admin_funnel_kb.button(text='📊 Статистика', callback_data='funnel_s
 admin_funnel_kb.button(text='🔙 Назад', callback_data='back_to_admin')
 admin_funnel_kb.adjust(2)
 
+# Клавиатура экрана статистики воронки
+def get_funnel_stats_kb(funnel_id: int) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    kb.button(text='👤 Список завершивших', callback_data=f'funnel_completed:{funnel_id}:n:0')
+    kb.button(text='➕ Создать воронку', callback_data='create_funnel')
+    kb.button(text='📋 Список воронок', callback_data='list_funnels')
+    kb.button(text='📊 Статистика', callback_data='funnel_stats')
+    kb.button(text='🔙 Назад', callback_data='back_to_admin')
+    kb.adjust(1, 2)
+    return kb.as_markup()
+
+# Клавиатура листания списка завершивших воронку
+def get_funnel_completed_kb(funnel_id: int, first_id: int | None, last_id: int | None, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    buttons = []
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'funnel_completed:{funnel_id}:p:{first_id}'))
+    if has_next:
+        nav.append(InlineKeyboardButton(text='Вперед ➡️', callback_data=f'funnel_completed:{funnel_id}:n:{last_id}'))
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(text='📊 К статистике', callback_data=f'stats_funnel:{funnel_id}')])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 # Функция для создания клавиатуры выбора воронки
 def get_funnel_selection_kb(funnels, action='select_funnel'):
     kb = InlineKeyboardBuilder()
@@ -0,0 +1,42 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+class UpdatesConcurrencyLimit(BaseMiddleware):
+    """
+    Ограничивает число одновременно обрабатываемых обновлений (outer-middleware dp.update)
+
+    Один механизм для поллинга и вебхука: обновления сверх лимита ждут своей
+    очереди до остальных middleware, поэтому не держат сессию БД и соединение
+    из пула. При остановке бота wait_idle дожидается уже принятых обновлений.
+
+    Args:
+        max_in_flight: Сколько обновлений обрабатывается одновременно
+    """
+    def __init__(self, max_in_flight: int):
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._accepted = 0  # Обрабатываются и ждут очереди
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        self._accepted += 1
+        self._idle.clear()
+        try:
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self._accepted -= 1
+            if not self._accepted:
+                self._idle.set()
+
+    async def wait_idle(self):
+        """Дожидается обработки всех принятых обновлений (для dp.shutdown)"""
+        await self._idle.wait()
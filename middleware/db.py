@@ -1,18 +1,119 @@
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
 from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
-from aiogram.types import Message, TelegramObject
-from sqlalchemy.ext.asyncio.session import async_sessionmaker
+from aiogram.types import Message, TelegramObject, User
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio.session import AsyncSession, async_sessionmaker
+from config import LAST_SEEN_UPDATE_INTERVAL
+from database.orm_query import touch_user_last_seen
+
+
+@dataclass(slots=True)
+class DbStats:
+    """Статистика запросов к БД за одно обновление"""
+    queries: int = 0
+    time: float = 0.0  # Суммарное время запросов (сек)
+
+
+# Статистика текущего обновления, ее заполняют обработчики событий движка
+db_stats: ContextVar[DbStats | None] = ContextVar('db_stats', default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = db_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.time += time.perf_counter() - context._query_started
+
+def track_queries(engine: Engine):
+    """Подключает подсчет запросов и времени БД к движку (один раз)"""
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+class LazySession:
+    """
+    Сессия БД, которая создается только при первом обращении
+
+    Обработчики, которые не работают с БД, не создают сессию и не берут соединение из пула.
+    Остальные работают с объектом как с обычной AsyncSession.
+    """
+    __slots__ = ('_session_pool', '_session')
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self._session_pool = session_pool
+        self._session: AsyncSession | None = None
+
+    @property
+    def is_started(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name: str) -> Any:
+        if self._session is None:
+            self._session = self._session_pool()
+        return getattr(self._session, name)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
 
 class DataBaseSession(BaseMiddleware):
+    """
+    Передает обработчикам ленивую сессию БД и обновляет users.last_seen
+
+    last_seen обновляется только в обновлениях, где обработчик уже открыл сессию,
+    в том же соединении и не чаще LAST_SEEN_UPDATE_INTERVAL для одного пользователя
+    (после перезапуска - одним условным UPDATE, который не меняет свежие строки).
+    Обновления без работы с БД по-прежнему не берут соединение из пула.
+    """
     def __init__(self, session_pool: async_sessionmaker):
         self.session_pool = session_pool
+        self._seen_at: dict[int, float] = {}  # tg_id -> время последнего обновления last_seen (monotonic)
+        track_queries(session_pool.kw['bind'].sync_engine)
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
         event: TelegramObject,
         data: Dict[str, Any],
-    ) -> Any:  
-        async with self.session_pool() as session:
-            data['session'] = session
-            return await handler(event, data)
-    
\ No newline at end of file
+    ) -> Any:
+        session = LazySession(self.session_pool)
+        stats = DbStats()
+        token = db_stats.set(stats)
+        data['session'] = session
+        data['db_stats'] = stats
+        try:
+            result = await handler(event, data)
+            if session.is_started:
+                await self._touch_last_seen(session, data.get('event_from_user'))
+            return result
+        finally:
+            await session.close()
+            db_stats.reset(token)
+            if session.is_started:
+                logging.debug("Запросов к БД за обновление: %d, %.1f мс", stats.queries, stats.time * 1000)
+
+    async def _touch_last_seen(self, session: LazySession, user: User | None):
+        if user is None or user.is_bot:
+            return
+        now = time.monotonic()
+        seen_at = self._seen_at.get(user.id)
+        if seen_at is not None and now - seen_at < LAST_SEEN_UPDATE_INTERVAL:
+            return
+        if len(self._seen_at) >= 100_000:
+            self._seen_at = {tg_id: ts for tg_id, ts in self._seen_at.items() if now - ts < LAST_SEEN_UPDATE_INTERVAL}
+        self._seen_at[user.id] = now
+        try:
+            # Незакоммиченное обработчиком все равно отбросило бы закрытие сессии
+            await session.rollback()
+            await touch_user_last_seen(session, user.id)
+        except Exception:
+            logging.exception(f"Не удалось обновить last_seen пользователя {user.id}")
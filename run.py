@@ -1,7 +1,10 @@
 import asyncio
 import logging
+import secrets
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from handlers.user_router import user_router
 from handlers.admin_router import admin_router
@@ -9,26 +12,70 @@ from handlers.funnel_admin_router import funnel_admin_router
 from handlers.funnel_user_router import funnel_user_router
 from handlers.user_profile_router import user_profile_router
 from middleware.db import DataBaseSession
+from middleware.concurrency import UpdatesConcurrencyLimit
 from database.engine import create_db, session_maker
 from handlers.broadcast_router import broadcast_router
-from config import BOT_TOKEN
+from config import BOT_TOKEN, TELEGRAM_API_URL, BOT_RUN_MODE, UPDATES_MAX_IN_FLIGHT, \
+    WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET
+from utils.broadcast_jobs import BroadcastManager
+from utils.broadcast_scheduler import BroadcastScheduler
 from utils.logging_config import configure_logging
+from utils.webhook import start_webhook_server
 
 
 logger = logging.getLogger(__name__)
 
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML)) 
-dp = Dispatcher()
+# Кастомный Bot API сервер (например, mock для нагрузочных тестов)
+api_session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=api_session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+broadcast_manager = BroadcastManager(bot, session_maker)
+broadcast_scheduler = BroadcastScheduler(session_maker, broadcast_manager)
+dp = Dispatcher(broadcast_manager=broadcast_manager, broadcast_scheduler=broadcast_scheduler)
+# Один лимит одновременной обработки для поллинга и вебхука
+updates_limit = UpdatesConcurrencyLimit(UPDATES_MAX_IN_FLIGHT)
+dp.update.outer_middleware(updates_limit)
+# При остановке сначала дожидаемся принятых обновлений
+dp.shutdown.register(updates_limit.wait_idle)
+dp.shutdown.register(broadcast_scheduler.shutdown)
+dp.shutdown.register(broadcast_manager.shutdown)
 dp.include_routers(admin_router, funnel_admin_router, broadcast_router, funnel_user_router, user_profile_router, user_router)
 
-async def main():
-    dp.update.middleware(DataBaseSession(session_pool=session_maker))
-    await create_db()
+async def run_polling():
     await bot.delete_webhook(drop_pending_updates=True)
     logger.info("Бот запущен и начал поллинг")  # Сообщение здесь
     await dp.start_polling(bot)
 
+async def run_webhook():
+    if not WEBHOOK_BASE_URL:
+        raise ValueError("WEBHOOK_BASE_URL environment variable is not set")
+    secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    runner = await start_webhook_server(
+        dp, bot, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, secret_token=secret_token
+    )
+    try:
+        await bot.set_webhook(
+            url=WEBHOOK_BASE_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(UPDATES_MAX_IN_FLIGHT, 100),
+            drop_pending_updates=True,
+        )
+        logger.info("Бот запущен в режиме вебхука")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def main():
+    dp.update.middleware(DataBaseSession(session_pool=session_maker))
+    await create_db()
+    await broadcast_manager.resume()
+    await broadcast_scheduler.start()
+    if BOT_RUN_MODE == 'webhook':
+        await run_webhook()
+    else:
+        await run_polling()
+
 if __name__ == '__main__':
     configure_logging(level=logging.INFO)
     try:
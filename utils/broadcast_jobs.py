@@ -0,0 +1,191 @@
+import asyncio
+import contextvars
+import json
+import logging
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from sqlalchemy import and_
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from config import BROADCAST_PROGRESS_INTERVAL
+from database.models import BroadcastJob, User
+from database.orm_query import get_unfinished_broadcast_jobs, finish_broadcast_job, count_active_users, get_segment_condition
+from utils.broadcast_utils import BroadcastStats, send_broadcast, format_broadcast_result, format_broadcast_progress
+import keyboards.admin_kb as admin_kb
+
+
+async def run_broadcast_job(
+    bot: Bot,
+    session: AsyncSession,
+    job: BroadcastJob,
+    stats: BroadcastStats | None = None,
+    cancel_event: asyncio.Event | None = None,
+) -> BroadcastStats:
+    """
+    Выполняет (или продолжает с чекпоинта) задачу рассылки
+    
+    Args:
+        bot: Экземпляр бота
+        session: Сессия БД
+        job: Задача рассылки
+        stats: Объект статистики, который можно читать во время рассылки
+        cancel_event: Событие для остановки рассылки
+    
+    Returns:
+        BroadcastStats: Результат рассылки с учетом предыдущих запусков
+    """
+    stats = await send_broadcast(
+        bot=bot,
+        session=session,
+        send_func=getattr(bot, job.method),
+        content_type=job.content_type,
+        job=job,
+        stats=stats,
+        cancel_event=cancel_event,
+        **json.loads(job.payload)
+    )
+    await finish_broadcast_job(session, job, 'cancelled' if stats.cancelled else 'done')
+    return stats
+
+
+def describe_broadcast_job(job: BroadcastJob) -> str:
+    """Короткое описание контента рассылки для админа"""
+    payload = json.loads(job.payload)
+    if job.method == 'send_video':
+        return payload.get('caption') or 'Видео без подписи'
+    return payload.get('text') or payload.get('video_note') or ''
+
+
+class BroadcastManager:
+    """
+    Запускает рассылки в фоне и показывает админу их прогресс
+
+    Прогресс выводится в одно сообщение, которое обновляется не чаще
+    BROADCAST_PROGRESS_INTERVAL секунд, под ним кнопка остановки рассылки.
+    """
+    def __init__(self, bot: Bot, session_pool: async_sessionmaker):
+        self.bot = bot
+        self.session_pool = session_pool
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._cancel_events: dict[int, asyncio.Event] = {}
+
+    def is_running(self, job_id: int) -> bool:
+        return job_id in self._tasks
+
+    def start(self, job_id: int) -> bool:
+        """Запускает рассылку в фоне, сразу возвращая управление"""
+        if job_id in self._tasks:
+            return False
+        self._cancel_events[job_id] = asyncio.Event()
+        # Пустой контекст: рассылка переживает обновление, из которого запущена,
+        # и ее запросы не должны попадать в статистику БД этого обновления
+        task = asyncio.create_task(self._run(job_id), context=contextvars.Context())
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._forget(job_id))
+        return True
+
+    def cancel(self, job_id: int) -> bool:
+        """Останавливает рассылку: новые отправки не начинаются, начатые завершаются"""
+        cancel_event = self._cancel_events.get(job_id)
+        if cancel_event is None:
+            return False
+        cancel_event.set()
+        return True
+
+    async def resume(self):
+        """Продолжает рассылки, прерванные перезапуском бота"""
+        async with self.session_pool() as session:
+            jobs = await get_unfinished_broadcast_jobs(session)
+        for job in jobs:
+            logging.info("Продолжаем рассылку #%d с tg_id > %s", job.id, job.last_tg_id)
+            self.start(job.id)
+
+    async def shutdown(self):
+        """Прерывает рассылки при остановке бота, они продолжатся при следующем запуске"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _forget(self, job_id: int):
+        self._tasks.pop(job_id, None)
+        self._cancel_events.pop(job_id, None)
+
+    async def _run(self, job_id: int):
+        async with self.session_pool() as session:
+            job = await session.get(BroadcastJob, job_id)
+            if job is None:
+                logging.warning("Рассылка #%d не найдена", job_id)
+                return
+            stats = BroadcastStats()
+            # Оставшиеся получатели - как их выберет send_broadcast: после чекпоинта,
+            # без обработанных в прошлом запуске (done_ahead), они уже в счетчиках
+            condition = get_segment_condition(job.segment, job.segment_funnel_id)
+            done_ahead = json.loads(job.done_ahead) if job.done_ahead else []
+            if done_ahead:
+                exclude_done = User.tg_id.not_in(done_ahead)
+                condition = exclude_done if condition is None else and_(condition, exclude_done)
+            stats.total = (
+                job.success_count + job.failed_count
+                + await count_active_users(session, after_tg_id=job.last_tg_id, condition=condition)
+            )
+            progress_message_id = await self._send_progress(job, stats)
+            ticker = None
+            if progress_message_id is not None:
+                ticker = asyncio.create_task(self._update_progress(job, stats, progress_message_id))
+            try:
+                stats = await run_broadcast_job(self.bot, session, job, stats, self._cancel_events[job_id])
+                result_text = format_broadcast_result(stats, job.content_type, describe_broadcast_job(job))
+            except asyncio.CancelledError:
+                logging.info("Рассылка #%d прервана остановкой бота", job_id)
+                raise
+            except Exception:
+                logging.exception(f"Ошибка при выполнении рассылки #{job_id}")
+                result_text = f"❌ Рассылка #{job_id} прервана из-за ошибки\n\nОна продолжится после перезапуска бота."
+            finally:
+                if ticker is not None:
+                    # Дожидаемся отмены, чтобы начатое обновление прогресса не перезаписало итог
+                    ticker.cancel()
+                    await asyncio.gather(ticker, return_exceptions=True)
+            if progress_message_id is not None:
+                await self._edit_progress(
+                    job, progress_message_id, result_text,
+                    reply_markup=admin_kb.back_to_admin.as_markup()
+                )
+
+    async def _send_progress(self, job: BroadcastJob, stats: BroadcastStats) -> int | None:
+        if job.admin_chat_id is None:
+            return None
+        try:
+            message = await self.bot.send_message(
+                chat_id=job.admin_chat_id,
+                text=format_broadcast_progress(job.id, job.content_type, stats),
+                reply_markup=admin_kb.get_broadcast_cancel_kb(job.id)
+            )
+            return message.message_id
+        except Exception:
+            logging.exception(f"Не удалось отправить прогресс рассылки #{job.id}")
+            return None
+
+    async def _update_progress(self, job: BroadcastJob, stats: BroadcastStats, message_id: int):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._edit_progress(
+                job, message_id,
+                format_broadcast_progress(job.id, job.content_type, stats),
+                reply_markup=admin_kb.get_broadcast_cancel_kb(job.id)
+            )
+
+    async def _edit_progress(self, job: BroadcastJob, message_id: int, text: str, reply_markup):
+        try:
+            await self.bot.edit_message_text(
+                chat_id=job.admin_chat_id,
+                message_id=message_id,
+                text=text,
+                reply_markup=reply_markup
+            )
+        except TelegramBadRequest as e:
+            # Текст не изменился с прошлого обновления
+            if 'message is not modified' not in e.message:
+                logging.warning("Не удалось обновить прогресс рассылки #%d: %s", job.id, e)
+        except Exception:
+            logging.exception(f"Не удалось обновить прогресс рассылки #{job.id}")
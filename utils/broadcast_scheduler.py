@@ -0,0 +1,78 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from database.orm_query import get_scheduled_broadcast_jobs, change_broadcast_job_status
+from utils.broadcast_jobs import BroadcastManager
+
+
+class BroadcastScheduler:
+    """
+    Запускает запланированные рассылки в нужное время
+
+    Рассылки хранятся в куче по времени запуска. Одна задача спит до ближайшей
+    рассылки и просыпается раньше только при добавлении новой, поэтому
+    ожидающие рассылки не нагружают процессор.
+    """
+    def __init__(self, session_pool: async_sessionmaker, manager: BroadcastManager):
+        self.session_pool = session_pool
+        self.manager = manager
+        self._heap: list[tuple[datetime, int]] = []
+        self._cancelled: set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        """Загружает запланированные рассылки из БД и запускает планировщик"""
+        async with self.session_pool() as session:
+            jobs = await get_scheduled_broadcast_jobs(session)
+        for job in jobs:
+            heapq.heappush(self._heap, (job.scheduled_at, job.id))
+        logging.info("Загружено запланированных рассылок: %d", len(jobs))
+        self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def add(self, job_id: int, scheduled_at: datetime):
+        """Добавляет рассылку, уже сохраненную в БД со статусом scheduled"""
+        heapq.heappush(self._heap, (scheduled_at, job_id))
+        self._wakeup.set()
+
+    def discard(self, job_id: int):
+        """Убирает рассылку из расписания (из кучи она удалится при наступлении времени)"""
+        self._cancelled.add(job_id)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            scheduled_at, job_id = self._heap[0]
+            delay = (scheduled_at - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            if job_id in self._cancelled:
+                self._cancelled.discard(job_id)
+                continue
+            await self._fire(job_id)
+
+    async def _fire(self, job_id: int):
+        try:
+            async with self.session_pool() as session:
+                # Рассылку могли отменить через БД, поэтому переводим статус условно
+                started = await change_broadcast_job_status(session, job_id, 'pending', expected_status='scheduled')
+            if started:
+                logging.info("Запуск запланированной рассылки #%d", job_id)
+                self.manager.start(job_id)
+        except Exception:
+            logging.exception(f"Ошибка запуска запланированной рассылки #{job_id}")
@@ -1,60 +1,552 @@
 import asyncio
+import json
 import logging
-from typing import Callable
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import AsyncIterator, Callable
 from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
-from database.orm_query import get_active_users, deactivate_user
+from config import (
+    BROADCAST_RATE_LIMIT,
+    BROADCAST_CHAT_INTERVAL,
+    BROADCAST_WORKERS,
+    BROADCAST_CHUNK_SIZE,
+    BROADCAST_MAX_RETRIES,
+    BROADCAST_RETRY_BASE_DELAY,
+    BROADCAST_CHECKPOINT_EVERY,
+    BROADCAST_MIN_RATE,
+    BROADCAST_RATE_INCREASE,
+    BROADCAST_RATE_DECREASE,
+    BROADCAST_MAX_FLOOD_RETRIES,
+    BROADCAST_LOG_BATCH,
+)
+from database.models import BroadcastJob
+from database.orm_query import (
+    stream_active_user_ids,
+    deactivate_users,
+    save_broadcast_checkpoint,
+    add_broadcast_deliveries,
+    get_segment_condition,
+)
+
+# Ответы Telegram, после которых пользователю больше нельзя писать
+PERMANENT_ERROR_REASONS = (
+    'chat not found',
+    'user is deactivated',
+    'bot was blocked',
+    'peer_id_invalid',
+    "bot can't initiate conversation",
+)
+
+
+class TokenBucket:
+    """
+    Token bucket для глобального лимита отправки сообщений
+
+    Args:
+        rate: Количество токенов в секунду (0 - без ограничений)
+        burst: Максимальный запас токенов (по умолчанию равен rate)
+    """
+    def __init__(self, rate: float, burst: int | None = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет, пока в ведре появится токен, и забирает его"""
+        if self.rate <= 0:
+            return
+        # Лок держится и во время ожидания: ожидающие получают токены строго по очереди
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def set_rate(self, rate: float):
+        """Меняет скорость, запас токенов не превышает новую скорость"""
+        self.rate = rate
+        self.capacity = max(1, int(rate))
+        self._tokens = min(self._tokens, self.capacity)
+
+    def drain(self):
+        """Сбрасывает накопленный запас, чтобы после паузы не было всплеска отправок"""
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+
+
+class ChatRateLimiter:
+    """
+    Лимит на количество сообщений в один чат
+
+    Args:
+        interval: Минимальный интервал между сообщениями в один чат (в секундах)
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_allowed: dict[int, float] = {}
+        self._prune_at = 1024
+
+    async def acquire(self, chat_id: int):
+        """Ждет, пока в чат снова можно будет отправить сообщение"""
+        now = time.monotonic()
+        # Слот резервируется до ожидания: следующий вызов для того же чата встанет за ним
+        slot = max(now, self._next_allowed.get(chat_id, 0.0))
+        self._next_allowed[chat_id] = slot + self.interval
+        if len(self._next_allowed) >= self._prune_at:
+            self._prune(now)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _prune(self, now: float):
+        """Удаляет чаты, для которых лимит уже истек, чтобы словарь не рос бесконечно"""
+        self._next_allowed = {chat_id: ts for chat_id, ts in self._next_allowed.items() if ts > now}
+        self._prune_at = max(1024, len(self._next_allowed) * 2)
+
+
+class RateGovernor:
+    """
+    Адаптивный (AIMD) регулятор скорости рассылки поверх token bucket
+
+    На TelegramRetryAfter вся рассылка ставится на паузу на retry_after секунд,
+    а скорость уменьшается в decrease раз. Каждую секунду отправок без
+    флуд-контроля скорость растет на increase, но не выше max_rate.
+
+    Args:
+        bucket: Token bucket, скорость которого регулируется
+        max_rate: Максимальная скорость (0 - без ограничений, регулируются только паузы)
+        min_rate: Минимальная скорость
+        increase: Прирост скорости (сообщений в секунду)
+        decrease: Множитель скорости при флуд-контроле
+    """
+    def __init__(self, bucket: TokenBucket, max_rate: float, min_rate: float, increase: float, decrease: float):
+        self.bucket = bucket
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._resume_at = 0.0
+        self._successes = 0
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    @property
+    def paused_for(self) -> float:
+        """Сколько секунд осталось до конца паузы"""
+        return max(self._resume_at - time.monotonic(), 0.0)
+
+    async def acquire(self):
+        """Ждет окончания паузы и токен на отправку"""
+        while True:
+            delay = self.paused_for
+            if delay <= 0:
+                await self.bucket.acquire()
+                # Пауза могла начаться, пока ждали токен
+                if self.paused_for <= 0:
+                    return
+            else:
+                await asyncio.sleep(delay)
+
+    def on_success(self):
+        if self.max_rate <= 0:
+            return
+        self._successes += 1
+        if self._successes >= max(self.bucket.rate, 1):
+            self._successes = 0
+            if self.bucket.rate < self.max_rate:
+                self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.increase))
+
+    def on_retry_after(self, retry_after: float):
+        now = time.monotonic()
+        # Несколько воркеров получают 429 одновременно: скорость снижаем один раз за паузу
+        if self._resume_at <= now and self.max_rate > 0:
+            self.bucket.set_rate(max(self.min_rate, self.bucket.rate * self.decrease))
+            logging.warning(
+                "Флуд-контроль Telegram: пауза %s с, скорость снижена до %.1f сообщ./с",
+                retry_after, self.bucket.rate
+            )
+        self._resume_at = max(self._resume_at, now + retry_after)
+        self._successes = 0
+        self.bucket.drain()
+
+
+# Лимитеры общие для всех рассылок: параллельные рассылки делят один лимит Telegram
+broadcast_limiter = TokenBucket(BROADCAST_RATE_LIMIT)
+broadcast_governor = RateGovernor(
+    broadcast_limiter,
+    max_rate=BROADCAST_RATE_LIMIT,
+    min_rate=BROADCAST_MIN_RATE,
+    increase=BROADCAST_RATE_INCREASE,
+    decrease=BROADCAST_RATE_DECREASE,
+)
+chat_limiter = ChatRateLimiter(BROADCAST_CHAT_INTERVAL)
+
+
+class DeliveryCursor:
+    """
+    Чекпоинт рассылки по tg_id
+
+    Получатели отправляются в порядке возрастания tg_id, но воркеры завершают
+    отправки не по порядку. Поэтому храним last_tg_id - все получатели до него
+    включительно обработаны, и done_ahead - обработанные получатели после него.
+
+    Args:
+        last_tg_id: Чекпоинт предыдущего запуска
+        done_ahead: Получатели после чекпоинта, обработанные в предыдущем запуске
+    """
+    def __init__(self, last_tg_id: int | None = None, done_ahead: list[int] | None = None):
+        self.last_tg_id = last_tg_id
+        self._delivered_ahead = set(done_ahead or ())
+        self._in_flight: deque[int] = deque()
+        self._done: set[int] = set()
+
+    def is_delivered(self, tg_id: int) -> bool:
+        """Получатель уже обработан в предыдущем запуске"""
+        return tg_id in self._delivered_ahead
+
+    def dispatch(self, tg_id: int):
+        self._in_flight.append(tg_id)
+
+    def complete(self, tg_id: int):
+        self._done.add(tg_id)
+        while self._in_flight and self._in_flight[0] in self._done:
+            self.last_tg_id = self._in_flight.popleft()
+            self._done.discard(self.last_tg_id)
+
+    @property
+    def done_ahead(self) -> list[int]:
+        if self.last_tg_id is not None:
+            self._delivered_ahead = {tg_id for tg_id in self._delivered_ahead if tg_id > self.last_tg_id}
+        return sorted(self._done | self._delivered_ahead)
+
+
+class DeliveryLogWriter:
+    """
+    Буфер журнала доставки рассылки
+
+    Воркеры только добавляют записи в память, в БД они пишутся пачками
+    (bulk insert) вместе с остальной работой с сессией.
+
+    Args:
+        job_id: ID рассылки
+        batch_size: Размер пачки, после которого буфер стоит сбросить
+    """
+    def __init__(self, job_id: int, batch_size: int = BROADCAST_LOG_BATCH):
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self._rows: list[dict] = []
+
+    @property
+    def full(self) -> bool:
+        return len(self._rows) >= self.batch_size
+
+    def add(self, tg_id: int, status: str, error_code: str | None = None, latency: float | None = None):
+        self._rows.append({
+            'job_id': self.job_id,
+            'tg_id': tg_id,
+            'status': status,
+            'error_code': error_code,
+            'latency_ms': round(latency * 1000) if latency is not None else None,
+            'created_at': datetime.now(),
+        })
+
+    async def flush(self, session: AsyncSession):
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        await add_broadcast_deliveries(session, rows)
+
+
+@dataclass
+class BroadcastStats:
+    """Результат рассылки"""
+    success: int = 0
+    failed: int = 0
+    deactivated: int = 0
+    flood_waits: int = 0  # Сколько раз Telegram ответил TelegramRetryAfter
+    resumed: int = 0  # Обработано в предыдущих запусках (при продолжении рассылки)
+    total: int | None = None  # Ожидаемое количество получателей (для оценки оставшегося времени)
+    cancelled: bool = False
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float | None = None
+
+    @property
+    def processed(self) -> int:
+        return self.success + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        """Длительность рассылки в секундах"""
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Фактическая скорость рассылки (сообщений в секунду)"""
+        elapsed = self.elapsed
+        return (self.processed - self.resumed) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        """Оценка оставшегося времени рассылки в секундах"""
+        rate = self.rate
+        if self.total is None or rate <= 0:
+            return None
+        return max(self.total - self.processed, 0) / rate
+
+
+def is_permanent_error(error: Exception) -> bool:
+    """Пользователь заблокировал бота, удалил аккаунт или чат не существует"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    if isinstance(error, (TelegramBadRequest, TelegramNotFound)):
+        message = error.message.lower()
+        return any(reason in message for reason in PERMANENT_ERROR_REASONS)
+    return False
+
+
+def get_error_code(error: Exception) -> str:
+    """Код ошибки для журнала доставки: ответ Telegram или имя исключения"""
+    if isinstance(error, TelegramAPIError) and not isinstance(error, TelegramNetworkError):
+        return error.message[:100]
+    return type(error).__name__
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Временная ошибка (сеть, сервер Telegram), отправку стоит повторить
+
+    TelegramRetryAfter сюда не относится: флуд-контроль обрабатывается отдельно
+    возвратом получателя в очередь (BROADCAST_MAX_FLOOD_RETRIES).
+    """
+    return isinstance(error, (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError))
+
+
+async def deliver(send_func: Callable, chat_id: int, **kwargs) -> float:
+    """
+    Отправляет сообщение с учетом лимитов, повторяя попытку при сетевых ошибках.
+    Возвращает время успешного запроса к Telegram в секундах (без ожидания лимитов).
+
+    TelegramRetryAfter пробрасывается наверх: его обрабатывает регулятор скорости,
+    а получатель возвращается в очередь.
+    """
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await chat_limiter.acquire(chat_id)
+        await broadcast_governor.acquire()
+        started = time.monotonic()
+        try:
+            await send_func(chat_id=chat_id, **kwargs)
+            broadcast_governor.on_success()
+            return time.monotonic() - started
+        except TelegramRetryAfter:
+            raise
+        except Exception as error:
+            if not is_transient_error(error) or attempt == BROADCAST_MAX_RETRIES:
+                raise
+            delay = BROADCAST_RETRY_BASE_DELAY * 2 ** attempt
+            logging.warning(
+                "Временная ошибка отправки пользователю %s (попытка %d): %s, повтор через %.1f с",
+                chat_id, attempt + 1, error, delay
+            )
+            await asyncio.sleep(delay)
+
 
 async def send_broadcast(
     bot: Bot,
     session: AsyncSession,
     send_func: Callable,
     content_type: str,
+    recipients: AsyncIterator[list[int]] | None = None,
+    job: BroadcastJob | None = None,
+    stats: BroadcastStats | None = None,
+    cancel_event: asyncio.Event | None = None,
     **kwargs
-    )-> tuple[int, int]:
+    ) -> BroadcastStats:
     """
     Общая функция для рассылки с обработкой лимитов Telegram
+
+    Отправка идет пулом из BROADCAST_WORKERS воркеров, темп задает общий
+    адаптивный регулятор (не более BROADCAST_RATE_LIMIT сообщений в секунду)
+    и лимит на чат. При TelegramRetryAfter вся рассылка встает на паузу,
+    а получатель возвращается в очередь. Для задачи рассылки результат
+    каждой доставки пишется в журнал broadcast_deliveries.
+    Получатели читаются из БД пачками, поэтому память не зависит от числа пользователей.
+    Временные ошибки повторяются с backoff, а пользователи с постоянными ошибками
+    (заблокировал бота, чат не найден) деактивируются одним UPDATE на пачку.
+    Если передана задача рассылки, каждые BROADCAST_CHECKPOINT_EVERY отправок
+    в нее сохраняется чекпоинт, и повторный запуск продолжает с него.
+    После установки cancel_event новые отправки не начинаются, уже начатые
+    дожидаются завершения.
     
     Args:
         bot: Экземпляр бота
         session: Сессия БД
         send_func: Функция отправки (bot.send_message, bot.send_video и т.д.)
         content_type: Тип контента для логирования
+        recipients: Асинхронный генератор пачек tg_id (по умолчанию активные пользователи сегмента задачи)
+        job: Задача рассылки для сохранения чекпоинтов
+        stats: Объект статистики, который можно читать во время рассылки
+        cancel_event: Событие для остановки рассылки
         **kwargs: Аргументы для функции отправки
     
     Returns:
-        tuple[int, int]: (success_count, failed_count)
+        BroadcastStats: Количество успешных/неудачных отправок и скорость рассылки
     """
-    users = await get_active_users(session)
-    if not users:
-        return 0, 0
-    
-    success_count = 0
-    failed_count = 0
-    batch_size = 30  # Лимит Telegram: 30 сообщений в секунду
-    delay = 1.0
-    
-    for i in range(0, len(users), batch_size):
-        batch = users[i:i+batch_size]
-        tasks = []
-        for user in batch:
-            task = send_func(chat_id=str(user.tg_id), **kwargs)
-            tasks.append((user, task))
-        for user, task in tasks:
+    if stats is None:
+        stats = BroadcastStats()
+    cursor = None
+    delivery_log = DeliveryLogWriter(job.id) if job is not None else None
+    if job is not None:
+        stats.success, stats.failed, stats.deactivated = job.success_count, job.failed_count, job.deactivated_count
+        stats.resumed = stats.processed
+        cursor = DeliveryCursor(job.last_tg_id, json.loads(job.done_ahead) if job.done_ahead else None)
+    if recipients is None:
+        after_tg_id = cursor.last_tg_id if cursor else None
+        condition = get_segment_condition(job.segment, job.segment_funnel_id) if job is not None else None
+        recipients = stream_active_user_ids(session, BROADCAST_CHUNK_SIZE, after_tg_id=after_tg_id, condition=condition)
+    checkpointed = stats.processed
+
+    queue: asyncio.Queue[int] = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
+    deactivate_buffer: list[int] = []
+    # Получатели, возвращенные в очередь после флуд-контроля: (tg_id, номер попытки)
+    flood_retry: deque[tuple[int, int]] = deque()
+
+    async def process(chat_id: int, flood_retries: int) -> bool:
+        """Возвращает False, если получатель возвращен в очередь"""
+        status, error_code, latency = 'sent', None, None
+        try:
+            latency = await deliver(send_func, chat_id, **kwargs)
+            stats.success += 1
+        except TelegramRetryAfter as error:
+            stats.flood_waits += 1
+            broadcast_governor.on_retry_after(error.retry_after)
+            if flood_retries < BROADCAST_MAX_FLOOD_RETRIES:
+                flood_retry.append((chat_id, flood_retries + 1))
+                return False
+            stats.failed += 1
+            status, error_code = 'failed', get_error_code(error)
+            logging.warning("Пользователю %s не удалось отправить из-за флуд-контроля", chat_id)
+        except Exception as error:
+            stats.failed += 1
+            error_code = get_error_code(error)
+            if is_permanent_error(error):
+                status = 'blocked'
+                deactivate_buffer.append(chat_id)
+                logging.warning("Пользователь %s недоступен: %s", chat_id, error)
+            else:
+                status = 'failed'
+                logging.exception(f"Ошибка отправки пользователю:  {chat_id}")
+        if delivery_log is not None:
+            delivery_log.add(chat_id, status, error_code, latency)
+        return True
+
+    async def worker():
+        while True:
+            # Возвращенные после флуд-контроля получатели отправляются в первую очередь
+            if flood_retry:
+                chat_id, flood_retries = flood_retry.popleft()
+            else:
+                chat_id, flood_retries = await queue.get(), 0
+            requeued = False
             try:
-                await task
-                success_count += 1
-            except Exception as e:
-                failed_count += 1
-                await deactivate_user(session, user.tg_id)
-                logging.exception(f"Ошибка отправки пользователю:  {user.tg_id}")
-        if i + batch_size < len(users):
-            await asyncio.sleep(delay)
-    return success_count, failed_count
+                requeued = not await process(chat_id, flood_retries)
+                # Прерванная (отмененная) отправка не попадает в чекпоинт и будет повторена
+                if not requeued and cursor:
+                    cursor.complete(chat_id)
+            finally:
+                # Получатель из flood_retry остается незавершенным элементом очереди
+                if not requeued:
+                    queue.task_done()
+
+    async def flush_deactivated():
+        # Сессию использует только эта корутина (через продюсер), воркеры лишь пополняют буфер
+        if not deactivate_buffer:
+            return
+        tg_ids = deactivate_buffer[:]
+        deactivate_buffer.clear()
+        await deactivate_users(session, tg_ids)
+        stats.deactivated += len(tg_ids)
+
+    async def flush_log():
+        if delivery_log is not None:
+            await delivery_log.flush(session)
+
+    async def checkpoint():
+        nonlocal checkpointed
+        # Сначала результаты: чекпоинт не должен опережать сохраненные данные
+        await flush_deactivated()
+        await flush_log()
+        checkpointed = stats.processed
+        await save_broadcast_checkpoint(
+            session, job, cursor.last_tg_id, cursor.done_ahead,
+            stats.success, stats.failed, stats.deactivated
+        )
+
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+    try:
+        async for chunk in recipients:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            for tg_id in chunk:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                if cursor:
+                    if cursor.is_delivered(tg_id):
+                        continue
+                    cursor.dispatch(tg_id)
+                await queue.put(tg_id)
+                if cursor and stats.processed - checkpointed >= BROADCAST_CHECKPOINT_EVERY:
+                    await checkpoint()
+                elif delivery_log is not None and delivery_log.full:
+                    await flush_log()
+            await flush_deactivated()
+        if cancel_event is not None and cancel_event.is_set():
+            stats.cancelled = True
+            # Получатели из очереди не отправлены и останутся за чекпоинтом
+            while not queue.empty():
+                queue.get_nowait()
+                queue.task_done()
+            while flood_retry:
+                flood_retry.popleft()
+                queue.task_done()
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if cursor:
+            await checkpoint()
+        else:
+            await flush_deactivated()
+
+    stats.finished_at = time.monotonic()
+    logging.info(
+        "Рассылка (%s) %s: отправлено %d, ошибок %d, деактивировано %d, флуд-контроль %d раз, %.1f сообщ./с",
+        content_type, "остановлена" if stats.cancelled else "завершена",
+        stats.success, stats.failed, stats.deactivated, stats.flood_waits, stats.rate
+    )
+    return stats
 
 def format_broadcast_result(
-    success_count: int, 
-    failed_count: int, 
+    stats: BroadcastStats,
     content_type: str, 
     content_description: str
     ) -> str:
@@ -62,20 +554,37 @@ def format_broadcast_result(
     Форматирует результат рассылки в читаемый вид
     
     Args:
-        success_count: Количество успешных отправок
-        failed_count: Количество неудачных отправок
+        stats: Результат рассылки
         content_type: Тип контента (текст, видео и т.д.)
         content_description: Описание контента
     
     Returns:
         str: Отформатированное сообщение о результате
     """
-    if success_count > 0 or failed_count > 0:
+    if stats.processed > 0:
+        title = "⛔ Рассылка {} остановлена" if stats.cancelled else "✅ Рассылка {} завершена!"
         return (
-            f"✅ Рассылка {content_type} завершена!\n\n"
-            f"📤 Отправлено: {success_count}\n"
-            f"❌ Ошибок: {failed_count}\n\n"
+            f"{title.format(content_type)}\n\n"
+            f"📤 Отправлено: {stats.success}\n"
+            f"❌ Ошибок: {stats.failed}\n"
+            f"🚫 Недоступны (деактивированы): {stats.deactivated}\n"
+            f"⚡ Скорость: {stats.rate:.1f} сообщ./с\n\n"
             f"📝 Контент: <i>\"{content_description}\"</i>"
         )
     else:
-        return "Список пользователей пуст"
\ No newline at end of file
+        return "Список пользователей пуст"
+
+
+def format_broadcast_progress(job_id: int, content_type: str, stats: BroadcastStats) -> str:
+    """Форматирует сообщение с текущим прогрессом рассылки"""
+    total = stats.total if stats.total is not None else '?'
+    eta = stats.eta
+    eta_text = f"~{int(eta // 60)} мин {int(eta % 60)} с" if eta is not None else "—"
+    return (
+        f"⏳ <b>Рассылка #{job_id}</b> ({content_type})\n\n"
+        f"📊 Обработано: {stats.processed} из {total}\n"
+        f"📤 Отправлено: {stats.success}\n"
+        f"❌ Ошибок: {stats.failed}\n"
+        f"⚡ Скорость: {stats.rate:.1f} сообщ./с\n"
+        f"🕐 Осталось: {eta_text}"
+    )
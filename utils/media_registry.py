@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import logging
+import os
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.orm_query import get_media_file_id, save_media_file_id, delete_media_file_id
+
+
+# Фрагменты ошибок Telegram, означающих, что file_id больше не принимается
+REJECTED_FILE_ID_ERRORS = ('file identifier', 'file_reference', 'file reference', 'wrong type of the web page content')
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_file_id_rejected(error: TelegramBadRequest) -> bool:
+    message = error.message.lower()
+    return any(marker in message for marker in REJECTED_FILE_ID_ERRORS)
+
+
+class MediaRegistry:
+    """
+    Отправляет локальные файлы, загружая каждый в Telegram один раз
+
+    file_id, полученный при первой загрузке, хранится в таблице media_files
+    по sha256 содержимого и типу медиа, поэтому переживает перезапуск бота.
+    Хэш пересчитывается, только если у файла изменились размер или mtime:
+    измененный файл загружается заново. Если Telegram отклоняет file_id,
+    он удаляется и файл загружается снова.
+    """
+    def __init__(self):
+        self._hashes: dict[str, tuple[int, int, str]] = {}  # путь -> (mtime_ns, размер, хэш)
+        self._file_ids: dict[tuple[str, str], str] = {}  # (хэш, тип) -> file_id
+        self._locks: dict[tuple[str, str], asyncio.Lock] = {}
+
+    async def content_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        content_hash = await asyncio.to_thread(file_sha256, path)
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, content_hash)
+        return content_hash
+
+    async def send(
+        self,
+        bot: Bot,
+        session: AsyncSession,
+        chat_id: int,
+        path: str,
+        media_type: str = 'photo',
+        filename: str | None = None,
+        **kwargs
+    ) -> Message:
+        """
+        Отправляет файл методом send_<media_type>, по возможности по сохраненному file_id
+
+        Args:
+            bot: Экземпляр бота
+            session: Сессия БД
+            chat_id: Чат получателя
+            path: Путь к локальному файлу
+            media_type: photo / video / document / animation
+            filename: Имя файла при загрузке
+            **kwargs: Остальные аргументы метода (caption, reply_markup...)
+        """
+        send_func = getattr(bot, f'send_{media_type}')
+        key = (await self.content_hash(path), media_type)
+        file_id = await self._get_file_id(session, key)
+        if file_id is not None:
+            try:
+                return await send_func(chat_id=chat_id, **{media_type: file_id}, **kwargs)
+            except TelegramBadRequest as e:
+                if not is_file_id_rejected(e):
+                    raise
+                logging.warning("Telegram отклонил file_id для %s, загружаем файл заново: %s", path, e)
+                self._file_ids.pop(key, None)
+                await delete_media_file_id(session, *key, file_id)
+
+        # Одновременные отправки одного файла ждут первой загрузки, а не загружают его параллельно
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                return await send_func(chat_id=chat_id, **{media_type: file_id}, **kwargs)
+            message = await send_func(chat_id=chat_id, **{media_type: FSInputFile(path, filename=filename)}, **kwargs)
+            file_id = message.photo[-1].file_id if media_type == 'photo' else getattr(message, media_type).file_id
+            await save_media_file_id(session, *key, file_id)
+            self._file_ids[key] = file_id
+            logging.info("Файл %s загружен в Telegram, file_id сохранен", path)
+            return message
+
+    async def _get_file_id(self, session: AsyncSession, key: tuple[str, str]) -> str | None:
+        file_id = self._file_ids.get(key)
+        if file_id is None:
+            file_id = await get_media_file_id(session, *key)
+            if file_id is not None:
+                self._file_ids[key] = file_id
+        return file_id
+
+
+media_registry = MediaRegistry()
@@ -0,0 +1,35 @@
+import logging
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+
+async def start_webhook_server(
+    dp: Dispatcher,
+    bot: Bot,
+    path: str,
+    host: str,
+    port: int,
+    secret_token: str | None = None,
+) -> web.AppRunner:
+    """
+    Запускает aiohttp-сервер вебхука в текущем event loop
+
+    Telegram получает ответ сразу, обновление обрабатывается в фоне. Число
+    одновременно обрабатываемых обновлений ограничивает UpdatesConcurrencyLimit
+    диспетчера, как и при поллинге. При старте сервера вызываются
+    startup-обработчики диспетчера, при остановке (await runner.cleanup()) -
+    shutdown-обработчики, как при поллинге.
+
+    Returns:
+        web.AppRunner: Раннер сервера для остановки
+    """
+    app = web.Application()
+    # Сначала shutdown-обработчики диспетчера, затем закрытие сессии бота обработчиком вебхука
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(dp, bot, handle_in_background=True, secret_token=secret_token).register(app, path=path)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Сервер вебхука слушает %s:%d%s", host, port, path)
+    return runner